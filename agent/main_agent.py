@@ -1,15 +1,48 @@
 # main_agent.py
 import os
+import atexit
+import importlib.util
+import httpx
 from autogen import AssistantAgent, UserProxyAgent, config_list_from_json
 
+class SharedHTTPClient(httpx.Client):
+    """
+    httpx.Client that survives autogen's copy of llm_config.
+
+    ConversableAgent deep-copies llm_config, and a plain client can't be
+    copied (it holds locks); returning self keeps one pool for every agent.
+    """
+
+    def __deepcopy__(self, memo):
+        return self
+
+# One keep-alive HTTP client shared by every agent, so repeated chats reuse
+# the pooled TCP/TLS connection to the API instead of reconnecting.
+# HTTP/2 is only enabled when the optional h2 package is installed.
+http_client = SharedHTTPClient(
+    http2=importlib.util.find_spec("h2") is not None,
+    limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+    timeout=60
+)
+atexit.register(http_client.close)
+
 # You can also load this from a .env file for security
 config_list = [
     {
         "model": "gpt-4o",
-        "api_key": os.getenv("OPENAI_API_KEY")
+        "api_key": os.getenv("OPENAI_API_KEY"),
+        "http_client": http_client  # Forwarded to the OpenAI client by autogen
     }
 ]
 
+# Shared LLM settings: cache_seed turns on autogen's on-disk response cache,
+# so identical prompts are answered without another API round-trip
+llm_config = {
+    "config_list": config_list,
+    "cache_seed": 42,
+    "temperature": 0
+}
+
 system_prompt = """
 You are a professional software refactor agent. When given source code, you:
 1. Identify reusable components and group them logically
@@ -23,20 +56,51 @@ You are a professional software refactor agent. When given source code, you:
 6. Await confirmation before making actual file edits
 """
 
-assistant = AssistantAgent(
-    name="RefactorAgent",
-    system_message=system_prompt,
-    llm_config={"config_list": config_list},
-    max_consecutive_auto_reply=1  # Limit to 1 auto-reply to prevent loops
-)
+def create_agents():
+    """
+    Build a fresh RefactorAgent/Developer pair.
 
-user = UserProxyAgent(
-    name="Developer",
-    human_input_mode="NEVER",
-    llm_config={"config_list": config_list},
-    code_execution_config={"use_docker": False},
-    max_consecutive_auto_reply=1  # Limit to 1 auto-reply to prevent loops
-)
+    Each pair keeps its own chat history, so concurrent refactors must each
+    use their own pair instead of sharing the module-level agents.
+    """
+    assistant = AssistantAgent(
+        name="RefactorAgent",
+        system_message=system_prompt,
+        llm_config=llm_config,
+        code_execution_config=False,
+        max_consecutive_auto_reply=1  # Limit to 1 auto-reply to prevent loops
+    )
+
+    user = UserProxyAgent(
+        name="Developer",
+        human_input_mode="NEVER",
+        llm_config=llm_config,
+        code_execution_config=False,  # Never run code blocks from the reply
+        max_consecutive_auto_reply=1  # Limit to 1 auto-reply to prevent loops
+    )
+
+    return assistant, user
+
+assistant, user = create_agents()
+
+def run_chat(message: str, agents=None) -> str:
+    """
+    Send a message to the RefactorAgent and return its final reply.
+
+    The reply is read straight from the assistant's chat history, so callers
+    don't have to capture stdout and rescan the whole transcript for it.
+
+    Args:
+        message: The task message to send
+        agents: Optional (assistant, user) pair; defaults to the module agents
+    """
+    chat_assistant, chat_user = agents or (assistant, user)
+    chat_user.initiate_chat(chat_assistant, message=message)
+
+    for reply in reversed(chat_assistant.chat_messages[chat_user]):
+        if reply.get("role") == "assistant" and reply.get("content"):
+            return reply["content"]
+    return ""
 
 def main():
     api_key = os.getenv("OPENAI_API_KEY")
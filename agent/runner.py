@@ -1,31 +1,64 @@
 # runner.py
 import os
+import re
 import ast
+import sys
 import json
-from main_agent import assistant, user
+import asyncio
+import secrets
 from tools import extract_top_level_functions
 from pathlib import Path
-from io import StringIO
-from contextlib import redirect_stdout
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib json module
+    orjson = None
 
 BACKEND_FILE = "../backend/main.py"
 PREVIEW_MODE = True
+MAX_CONCURRENT_REFACTORS = int(os.getenv("MAX_CONCURRENT_REFACTORS", "4"))
+READ_BUFFER_SIZE = 1 << 20
+MAX_WRITE_WORKERS = 8
+# Answer to the preview prompt: "1" applies the changes and "0" discards them
+# without asking. When unset, the prompt is shown only on a terminal, so
+# unattended runs never block on stdin.
+AUTO_ACCEPT = os.getenv("REFACTOR_ACCEPT")
+# Compact logs are appended to this one file, one JSON object per line
+NDJSON_LOG_NAME = "refactor_log.ndjson"
+
+# Static parts of the agent prompt; the source code goes between them
+_TASK_PREFIX = """
+    Analyze the following Python code. Identify reusable components (functions, classes)
+    and extract them into appropriate utils modules (e.g., utils/io.py, utils/text.py).
 
+    For each extracted component:
+    - Provide the new filename and code
+    - Modify the original code to import the extracted parts
 
-class CaptureUserOutput:
-    def __enter__(self):
-        self.buffer = StringIO()
-        self._redirect = redirect_stdout(self.buffer)
-        self._redirect.__enter__()
-        return self
+    Output the final result as JSON with these exact keys:
+    - 'refactored_main': The refactored version of the original file
+    - 'backup_file': The old boilerplate logic to be saved to a separate file
+    - 'utility_modules': Dictionary of extracted utility modules (filename -> code)
 
-    def __exit__(self, *args):
-        self._redirect.__exit__(*args)
-        self.output = self.buffer.getvalue()
+    Do NOT write any files — just return the JSON preview.
+
+    Here's the code:
+    ```python
+    """
+_TASK_SUFFIX = """
+    ```
+    """
+
+# Matches the JSON object inside a ```json (or bare ```) fence in one pass
+_FENCE_RE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL)
+# Decodes one JSON value from a given offset, ignoring whatever follows it
+_JSON_DECODER = json.JSONDecoder()
 
 
-def log_refactor_output(preview_dict: dict, original_file: Path, refactor_dir: Path):
+def log_refactor_output(preview_dict: dict, original_file: Path, refactor_dir: Path,
+                        caller: str = "runner", pretty: bool = True):
     """
     Log the refactor output to a JSON file for tracking and debugging.
 
@@ -33,87 +66,168 @@ def log_refactor_output(preview_dict: dict, original_file: Path, refactor_dir: P
         preview_dict: Dictionary containing the agent's refactor response
         original_file: Path to the original file that was refactored
         refactor_dir: Path to the refactor agent directory
+        caller: Recorded as "<caller>_called" in the log (e.g. "runner", "cli")
+        pretty: Write an indented JSON file for this run; pass False to append
+            one compact line to refactor_logs/refactor_log.ndjson instead
     """
     # Create refactor_logs directory if it doesn't exist
     logs_dir = refactor_dir / "refactor_logs"
     logs_dir.mkdir(exist_ok=True)
 
     # Create timestamp for filename
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H%M")
-    log_filename = logs_dir / f"{timestamp}.json"
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+
+    # Attach metadata in place instead of copying the (large) preview dict;
+    # the keys are removed again once the log has been written
+    metadata = {
+        "original_file": str(original_file.absolute()),
+        "refactor_timestamp": timestamp,
+        f"{caller}_called": True
+    }
+    replaced = {key: preview_dict[key] for key in metadata if key in preview_dict}
+    preview_dict.update(metadata)
 
-    # Add metadata to the dictionary
-    log_data = preview_dict.copy()
-    log_data["original_file"] = str(original_file.absolute())
-    log_data["refactor_timestamp"] = timestamp
-    log_data["runner_called"] = True
-
-    # Save to JSON file with UTF-8 encoding and indentation
-    with open(log_filename, "w", encoding="utf-8") as f:
-        json.dump(log_data, f, indent=2, ensure_ascii=False)
+    try:
+        if pretty:
+            # Random suffix so refactors finishing in the same second don't overwrite each other
+            log_filename = logs_dir / f"{timestamp}_{secrets.token_hex(3)}.json"
+            # Save to JSON file with UTF-8 encoding
+            if orjson is not None:
+                with open(log_filename, "wb") as f:
+                    f.write(orjson.dumps(preview_dict, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2))
+            else:
+                # json.dump streams chunks straight into the buffered file
+                with open(log_filename, "w", encoding="utf-8", buffering=READ_BUFFER_SIZE) as f:
+                    json.dump(preview_dict, f, indent=2, ensure_ascii=False)
+        else:
+            # One line per run in a single NDJSON file instead of a new file each time
+            log_filename = logs_dir / NDJSON_LOG_NAME
+            if orjson is not None:
+                line = orjson.dumps(preview_dict, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+            else:
+                line = (json.dumps(preview_dict, separators=(",", ":"), ensure_ascii=False) + "\n").encode("utf-8")
+            # Unbuffered O_APPEND: the record goes out in a single write call,
+            # so concurrent runs append whole lines
+            with open(log_filename, "ab", buffering=0) as f:
+                f.write(line)
+    finally:
+        for key in metadata:
+            del preview_dict[key]
+        preview_dict.update(replaced)
 
     print(f"📝 Refactor log saved: {log_filename}")
 
 
-def run_refactor_agent():
-    if not Path(BACKEND_FILE).exists():
-        print(f"❌ Source file not found: {BACKEND_FILE}")
-        return
+def build_task_message(source_code: str) -> str:
+    """Build the agent prompt for a single source file."""
+    # One join of known parts instead of re-rendering the whole template
+    return "".join((_TASK_PREFIX, source_code, _TASK_SUFFIX))
 
-    print(f"🔧 Refactoring: {BACKEND_FILE}")
-    print(f"⏰ Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
-    with open(BACKEND_FILE, "r") as f:
-        source_code = f.read()
+def parse_agent_output(output: str) -> dict:
+    """
+    Extract the JSON preview from the agent's reply.
 
-    # Optional: local AST preview
-    print("\n🔍 AST-extracted functions (local preview):")
-    extracted = extract_top_level_functions(source_code)
-    for name, code in extracted:
-        print(f"\n📌 Function: {name}\n{code}\n")
+    Raises:
+        ValueError: If no JSON object can be decoded from the output
+    """
+    # Prefer the fenced JSON block
+    match = _FENCE_RE.search(output)
+    if match:
+        json_str = match.group(1)
+        preview = orjson.loads(json_str) if orjson is not None else json.loads(json_str)
+    else:
+        # Unfenced reply: decode the object starting at the first brace, so any
+        # prose after it (even with braces of its own) is ignored
+        start = output.find('{')
+        if start == -1:
+            raise ValueError("No JSON object found in agent output")
+        preview = _JSON_DECODER.raw_decode(output, start)[0]
+
+    # Module names ("utils/helpers.py", ...) repeat across replies; interning
+    # keeps one copy per name in long-running workers such as the API
+    modules = preview.get('utility_modules') if isinstance(preview, dict) else None
+    if isinstance(modules, dict):
+        preview['utility_modules'] = {sys.intern(name): code for name, code in modules.items()}
+    return preview
+
+
+def refactor_source(source_code: str) -> str:
+    """
+    Send one source file to a dedicated agent pair and return the reply text.
 
-    # Agent task
-    task_message = f"""
-    Analyze the following Python code. Identify reusable components (functions, classes)
-    and extract them into appropriate utils modules (e.g., utils/io.py, utils/text.py).
+    Runs in a worker thread, so it must not share chat state with other files.
+    """
+    # Imported on first use: loading autogen and building the agents is slow,
+    # and importers that only need parse_agent_output/log_refactor_output
+    # (such as the CLI) shouldn't pay for it
+    from main_agent import create_agents, run_chat
 
-    For each extracted component:
-    - Provide the new filename and code
-    - Modify the original code to import the extracted parts
+    return run_chat(build_task_message(source_code), agents=create_agents())
 
-    Output the final result as JSON with these exact keys:
-    - 'refactored_main': The refactored version of the original file
-    - 'backup_file': The old boilerplate logic to be saved to a separate file
-    - 'utility_modules': Dictionary of extracted utility modules (filename -> code)
 
-    Do NOT write any files — just return the JSON preview.
+def _write_file(path: Path, content: str):
+    """Write UTF-8 text with raw os.write calls, bypassing the io text stack."""
+    data = memoryview(content.encode("utf-8"))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # os.write may accept fewer bytes than offered for large payloads
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
 
-    Here's the code:
-    ```python
-    {source_code}
-    ```
-    """
 
-    # Capture agent output
-    with CaptureUserOutput() as cap:
-        user.initiate_chat(assistant, message=task_message)
+def write_refactor_outputs(source_file: Path, preview_dict: dict):
+    """Write the refactored main file, backup and utility modules next to the source."""
+    # Collect every (label, path, content) first so directories are made once
+    writes = []
 
-    print("\n🧠 Agent output preview:")
-    output = cap.output
+    if 'refactored_main' in preview_dict:
+        writes.append(("Refactored main file", source_file, preview_dict['refactored_main']))
 
-    try:
-        # Extract JSON from the output
-        json_start = output.find('```json')
-        if json_start == -1:
-            json_start = output.find('{')
+    if 'backup_file' in preview_dict:
+        writes.append(("Backup file", source_file.with_suffix('.backup'), preview_dict['backup_file']))
+
+    if 'utility_modules' in preview_dict:
+        utils_dir = source_file.parent / "utils"
+        for util_name, util_content in preview_dict['utility_modules'].items():
+            # Remove 'utils/' prefix if present
+            clean_name = util_name.replace('utils/', '')
+            writes.append(("Utility module", utils_dir / clean_name, util_content))
+
+    for parent in {path.parent for _, path, _ in writes}:
+        parent.mkdir(parents=True, exist_ok=True)
+
+    if not writes:
+        return
+
+    # File writes release the GIL, so overlap them across a few threads
+    with ThreadPoolExecutor(max_workers=min(MAX_WRITE_WORKERS, len(writes))) as executor:
+        list(executor.map(lambda write: _write_file(write[1], write[2]), writes))
 
-        json_end = output.rfind('```')
-        if json_end == -1:
-            json_end = output.rfind('}') + 1
+    # One write for the whole list rather than a print per file
+    print("\n".join(f"✅ {label}: {path}" for label, path, _ in writes))
 
-        json_str = output[json_start:json_end].replace('```json', '').replace('```', '').strip()
-        preview_dict = json.loads(json_str)
 
+def review_refactor(source_file: Path, source_code: str, output):
+    """Show the local AST preview and the agent's proposal, then apply or prompt."""
+    print(f"\n🔧 Refactoring: {source_file}")
+
+    # Optional: local AST preview
+    print("\n🔍 AST-extracted functions (local preview):")
+    extracted = extract_top_level_functions(source_code)
+    for name, code in extracted:
+        print(f"\n📌 Function: {name}\n{code}\n")
+
+    if isinstance(output, Exception):
+        print(f"❌ Agent request failed: {output}")
+        return
+
+    print("\n🧠 Agent output preview:")
+
+    try:
+        preview_dict = parse_agent_output(output)
     except Exception as e:
         print(f"⚠️ Could not parse structured preview: {e}")
         print("Raw output:")
@@ -132,38 +246,12 @@ def run_refactor_agent():
             print(f"\n📄 {filename} Preview:\n{'='*40}\n{content}\n")
 
     # Log the refactor output
-    log_refactor_output(preview_dict, Path(BACKEND_FILE), Path(__file__).parent)
+    log_refactor_output(preview_dict, source_file, Path(__file__).parent)
 
     if not PREVIEW_MODE:
         # Write files directly to the backend directory
         print(f"\n💾 Writing files to backend directory...")
-
-        # Write refactored main file
-        if 'refactored_main' in preview_dict:
-            with open(BACKEND_FILE, "w") as f:
-                f.write(preview_dict['refactored_main'])
-            print(f"✅ Refactored main file: {BACKEND_FILE}")
-
-        # Write backup file
-        if 'backup_file' in preview_dict:
-            backup_file = Path(BACKEND_FILE).with_suffix('.backup')
-            with open(backup_file, "w") as f:
-                f.write(preview_dict['backup_file'])
-            print(f"✅ Backup file: {backup_file}")
-
-        # Write utility modules to utils directory
-        if 'utility_modules' in preview_dict:
-            utils_dir = Path(BACKEND_FILE).parent / "utils"
-            utils_dir.mkdir(exist_ok=True)
-
-            for util_name, util_content in preview_dict['utility_modules'].items():
-                # Remove 'utils/' prefix if present
-                clean_name = util_name.replace('utils/', '')
-                util_file = utils_dir / clean_name
-                with open(util_file, "w") as f:
-                    f.write(util_content)
-                print(f"✅ Utility module: {util_file}")
-
+        write_refactor_outputs(source_file, preview_dict)
         print(f"\n🎉 Refactoring complete!")
     else:
         print("\n✋ Preview only — no files were written.")
@@ -171,36 +259,16 @@ def run_refactor_agent():
 
         # Ask user if they want to accept the preview
         try:
-            accept = input("\n🤔 Would you like to accept these changes? (y/N): ").strip().lower()
+            if AUTO_ACCEPT is not None:
+                accept = "y" if AUTO_ACCEPT == "1" else "n"
+            elif sys.stdin.isatty():
+                accept = input("\n🤔 Would you like to accept these changes? (y/N): ").strip().lower()
+            else:
+                print("💡 No terminal to confirm on; set REFACTOR_ACCEPT=1 to apply without asking")
+                accept = "n"
             if accept in ['y', 'yes']:
                 print(f"\n💾 Writing files to backend directory...")
-
-                # Write refactored main file
-                if 'refactored_main' in preview_dict:
-                    with open(BACKEND_FILE, "w") as f:
-                        f.write(preview_dict['refactored_main'])
-                    print(f"✅ Refactored main file: {BACKEND_FILE}")
-
-                # Write backup file
-                if 'backup_file' in preview_dict:
-                    backup_file = Path(BACKEND_FILE).with_suffix('.backup')
-                    with open(backup_file, "w") as f:
-                        f.write(preview_dict['backup_file'])
-                    print(f"✅ Backup file: {backup_file}")
-
-                # Write utility modules to utils directory
-                if 'utility_modules' in preview_dict:
-                    utils_dir = Path(BACKEND_FILE).parent / "utils"
-                    utils_dir.mkdir(exist_ok=True)
-
-                    for util_name, util_content in preview_dict['utility_modules'].items():
-                        # Remove 'utils/' prefix if present
-                        clean_name = util_name.replace('utils/', '')
-                        util_file = utils_dir / clean_name
-                        with open(util_file, "w") as f:
-                            f.write(util_content)
-                        print(f"✅ Utility module: {util_file}")
-
+                write_refactor_outputs(source_file, preview_dict)
                 print(f"\n🎉 Changes accepted!")
             else:
                 print("❌ Changes not applied.")
@@ -210,5 +278,49 @@ def run_refactor_agent():
             print(f"❌ Error applying changes: {e}")
 
 
+async def run_refactor_agent_batch(files: list, max_concurrency: int = MAX_CONCURRENT_REFACTORS):
+    """
+    Refactor several files, overlapping the agent round-trips.
+
+    Chats are dispatched concurrently (bounded by ``max_concurrency``); the
+    previews and confirmation prompts are then shown one file at a time.
+
+    Args:
+        files: Paths of the source files to refactor
+        max_concurrency: Maximum number of agent chats in flight at once
+    """
+    sources = {}
+    for file in map(Path, files):
+        if not file.exists():
+            print(f"❌ Source file not found: {file}")
+            continue
+        with open(file, "r", buffering=READ_BUFFER_SIZE) as f:
+            sources[file] = f.read()
+
+    if not sources:
+        return
+
+    print(f"🔧 Refactoring {len(sources)} file(s): {', '.join(map(str, sources))}")
+    print(f"⏰ Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def request(source_code: str) -> str:
+        async with semaphore:
+            return await asyncio.to_thread(refactor_source, source_code)
+
+    outputs = await asyncio.gather(
+        *(request(source_code) for source_code in sources.values()),
+        return_exceptions=True
+    )
+
+    for (file, source_code), output in zip(sources.items(), outputs):
+        review_refactor(file, source_code, output)
+
+
+def run_refactor_agent():
+    asyncio.run(run_refactor_agent_batch([BACKEND_FILE]))
+
+
 if __name__ == "__main__":
     run_refactor_agent()
@@ -1,6 +1,6 @@
 # tools.py
-from typing import List, Tuple
 import ast
+from functools import lru_cache
 from typing import List, Tuple
 
 
@@ -20,20 +20,48 @@ def suggest_utils_categories(code: str) -> List[Tuple[str, str]]:
 
 # tools.py
 
+@lru_cache(maxsize=32)
+def _parse(code: str) -> ast.Module:
+    """
+    Parse source once per distinct text and reuse the tree on repeat calls.
+    The cached tree is shared, so callers must treat it as read-only.
+    """
+    return ast.parse(code)
+
+
+def top_level_function_names(code: str) -> List[str]:
+    """
+    Returns the names of all top-level functions without rendering their code.
+    Use this instead of extract_top_level_functions when only names are needed.
+    """
+    try:
+        tree = _parse(code)
+    except SyntaxError:
+        return []
+
+    return [node.name for node in tree.body if isinstance(node, ast.FunctionDef)]
+
+
 def extract_top_level_functions(code: str) -> List[Tuple[str, str]]:
     """
     Parses Python source code and extracts all top-level functions.
     Returns a list of (function_name, function_code) tuples.
+
+    The code is sliced from the original source by line number, which is
+    cheaper than ast.unparse and keeps comments and formatting intact.
     """
     try:
-        tree = ast.parse(code)
+        tree = _parse(code)
     except SyntaxError as e:
         return [("__error__", f"Syntax error: {e}")]
 
+    lines = code.splitlines(keepends=True)
     results = []
     for node in tree.body:
         if isinstance(node, ast.FunctionDef):
-            func_code = ast.unparse(node)
+            # Include any decorators, which sit above the def line
+            start = min([node.lineno] + [d.lineno for d in node.decorator_list])
+            func_code = "".join(lines[start - 1:node.end_lineno]).rstrip()
             results.append((node.name, func_code))
 
     return results
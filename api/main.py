@@ -3,45 +3,65 @@ FastAPI application for the refactor agent with Stripe integration.
 Provides paid API access to the refactor agent functionality.
 """
 
-from fastapi import FastAPI, HTTPException, Depends, Header, Request
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Optional, Dict, Any, List, Literal, get_args
 import os
 import sys
 import json
-import uuid
 import time
-from datetime import datetime, timedelta
+import secrets
+import threading
+import gzip
+import hashlib
+from datetime import datetime
 from pathlib import Path
 import stripe
 import logging
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, AsyncExitStack
+from functools import lru_cache
 import asyncio
+import anyio
 from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import orjson
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except ImportError:  # Fall back to the stdlib json module
+    orjson = None
+    from fastapi.responses import JSONResponse as DefaultResponse
+
 # Add the agent directory to path
 current_dir = Path(__file__).parent.parent
 agent_dir = current_dir / "agent"
-sys.path.append(str(agent_dir))
-sys.path.append(str(current_dir))
+# Skip entries that are already there (refactor_cli adds the agent dir too);
+# every extra sys.path entry costs a stat on each uncached import
+for import_dir in (str(agent_dir), str(current_dir)):
+    if import_dir not in sys.path:
+        sys.path.append(import_dir)
 
-from main_agent import assistant, user
+from main_agent import create_agents, run_chat
+from runner import parse_agent_output
+from api.storage import create_redis_client, compress_blob, decompress_blob, BLOB_CODEC, WatchError
 try:
     from refactor_cli import refactor_file, get_suggestion_prompt
 except ImportError:
     # Fallback implementation for testing
+    _FALLBACK_PROMPTS = {
+        "refactor": "Extract reusable components and improve code organization",
+        "optimize": "Optimize performance and efficiency", 
+        "document": "Add comprehensive documentation and type hints",
+        "style": "Apply PEP 8 style improvements",
+        "security": "Review and improve security practices"
+    }
+
     def get_suggestion_prompt(suggestion_type):
-        prompts = {
-            "refactor": "Extract reusable components and improve code organization",
-            "optimize": "Optimize performance and efficiency", 
-            "document": "Add comprehensive documentation and type hints",
-            "style": "Apply PEP 8 style improvements",
-            "security": "Review and improve security practices"
-        }
-        return prompts.get(suggestion_type, "Improve the code")
+        return _FALLBACK_PROMPTS.get(suggestion_type, "Improve the code")
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -52,60 +72,205 @@ stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 if not stripe.api_key:
     logger.warning("STRIPE_SECRET_KEY not set. Payment processing disabled.")
 
+# Per-call Stripe timeout; the SDK default of 80s would tie up a request far too long
+STRIPE_TIMEOUT_SECONDS = float(os.getenv("STRIPE_TIMEOUT_SECONDS", "10"))
+
+# httpx-backed Stripe client, so the *_async methods don't block the event
+# loop. HTTPXClient builds two separate pools, an httpx.AsyncClient for the
+# async calls and an httpx.Client for the sync ones (payment_integration), and
+# speaks HTTP/1.1 only: the SDK offers no way to enable HTTP/2 or pass in a
+# preconfigured client, so only the timeout is set here.
+stripe.default_http_client = stripe.HTTPXClient(
+    timeout=STRIPE_TIMEOUT_SECONDS,
+    allow_sync_methods=True
+)
+# SDK retries resend the same idempotency key, so they can't create duplicates
+stripe.max_network_retries = 2
+# Webhook bodies above this size are signature-checked off the event loop
+WEBHOOK_OFFLOAD_BYTES = 64 * 1024
+
 # Security
 security = HTTPBearer()
 
-# In-memory storage (replace with proper database in production)
-api_keys = {}
-usage_tracking = {}
-active_sessions = {}
+# Shared storage: every key lives under KEY_PREFIX. API keys are
+# "<prefix>apikey:<key>" hashes and in-flight refactors "<prefix>session:<id>"
+# keys that expire on their own
+KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "aa:")
+redis_client = create_redis_client()
+# Binary client for compressed blobs such as cached refactor results
+blob_client = create_redis_client(decode_responses=False)
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "600"))
+# Session records are only needed for debugging; otherwise start/finish is logged
+TRACE_SESSIONS = os.getenv("TRACE_SESSIONS", "").lower() in ("1", "true", "yes")
+# Keys whose payment never completes are dropped after this long
+PENDING_KEY_TTL_SECONDS = int(os.getenv("PENDING_KEY_TTL_SECONDS", "86400"))
+# Retries of /payment/create-intent with the same Idempotency-Key map back to
+# the first attempt for this long; Stripe keeps its own keys for 24 hours
+IDEMPOTENCY_WINDOW_SECONDS = 24 * 60 * 60
+# Finished refactor tasks stay readable by /refactor/status for this long
+TASK_TTL_SECONDS = int(os.getenv("TASK_TTL_SECONDS", "3600"))
+# A credit reserved for a queued or running refactor is held at most this
+# long, so a reservation leaked by a killed worker frees itself
+RESERVATION_TTL_SECONDS = int(os.getenv("RESERVATION_TTL_SECONDS", "1800"))
+
+# Per-key fixed-window limit on refactor submissions
+RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", "10"))
+RATE_LIMIT_WINDOW_SECONDS = 60
+
+# Background refactor tasks; holding a reference keeps them from being collected
+background_tasks = set()
+
+# Cap on parallel Stripe API calls, shared across requests
+STRIPE_MAX_CONCURRENCY = 10
+MAX_BATCH_CONFIRMATIONS = 100
+stripe_semaphore = asyncio.Semaphore(STRIPE_MAX_CONCURRENCY)
+
+# Payment intents in these states never change again, so they are safe to cache
+STRIPE_FINAL_STATUSES = {"succeeded", "canceled"}
+STRIPE_INTENT_CACHE_SECONDS = 300
+
+def json_dumps(obj) -> bytes:
+    """Serialize to compact JSON bytes (orjson when available)"""
+    return orjson.dumps(obj) if orjson is not None else json.dumps(obj).encode()
+
+def json_loads(data):
+    """Parse JSON from str or bytes (orjson when available)"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def format_timestamp(timestamp: Optional[str]) -> Optional[str]:
+    """Render a stored epoch-nanoseconds timestamp as ISO 8601"""
+    return datetime.fromtimestamp(int(timestamp) / 1e9).isoformat() if timestamp else None
+
+def refactor_cache_key(api_key: str, code: str, suggestion_type: str) -> str:
+    """
+    Content-addressed storage key for a refactor result.
+
+    Scoped to one API key, so a result is only ever served back to the
+    customer who paid for it.
+    """
+    digest = hashlib.blake2b(f"{api_key}|{suggestion_type}|{code}".encode(), digest_size=16).hexdigest()
+    return f"{KEY_PREFIX}refactor:v{REFACTOR_CACHE_REVISION}:{BLOB_CODEC}:{digest}"
+
+def api_key_record(api_key: str) -> str:
+    """Storage key for an API key's hash"""
+    return f"{KEY_PREFIX}apikey:{api_key}"
+
+async def record_request(record: str) -> int:
+    """Count a request against an API key and return its new total"""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hincrby(record, "total_requests", 1)
+        pipe.hset(record, "last_used", time.time_ns())
+        total_requests, _ = await pipe.execute()
+    return total_requests
+
+def reservation_record(api_key: str) -> str:
+    """Storage key for an API key's credit reservations (session id -> expiry)"""
+    return f"{KEY_PREFIX}reservations:{api_key}"
+
+def session_record(session_id: str) -> str:
+    """Storage key for an in-flight refactor session"""
+    return f"{KEY_PREFIX}session:{session_id}"
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for FastAPI app"""
     # Startup
     logger.info("Starting Refactor Agent API...")
+    # One size for sync handlers and agent runs (anyio) and for any
+    # run_in_executor(None, ...) / asyncio.to_thread offload
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREAD_POOL_SIZE
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="refactor")
+    )
+    workers = [asyncio.create_task(refactor_worker()) for _ in range(REFACTOR_WORKERS)]
     yield
     # Shutdown
     logger.info("Shutting down Refactor Agent API...")
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    await redis_client.aclose()
+    await blob_client.aclose()
 
 app = FastAPI(
     title="Refactor Agent API",
     description="AI-powered code refactoring service with Stripe integration",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=DefaultResponse
+)
+
+# CORS middleware; exact origins let preflight checks stay a set lookup
+CORS_ORIGINS = frozenset(
+    origin.strip() for origin in os.getenv("CORS_ORIGINS", "http://localhost:8000").split(",")
+    if origin.strip()
 )
 
-# CORS middleware
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
 )
 
-# Thread pool for blocking operations
-thread_pool = ThreadPoolExecutor(max_workers=5)
+# Compress larger responses (refactor results) for clients that accept gzip;
+# responses that already set Content-Encoding, like the landing page, pass through
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Worker threads for blocking operations (shared with FastAPI's sync handlers)
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "64"))
+
+# Refactor jobs wait in a bounded queue for a fixed set of agent workers;
+# once it's full new requests are turned away instead of piling up
+REFACTOR_WORKERS = int(os.getenv("REFACTOR_WORKERS", "8"))
+REFACTOR_QUEUE_SIZE = REFACTOR_WORKERS * 2
+REFACTOR_RETRY_AFTER_SECONDS = 30
+# How long a submission may wait for queue space before being turned away
+REFACTOR_ADMISSION_TIMEOUT = 0.2
+
+# Identical (api_key, suggestion_type, code) requests reuse the stored agent
+# result. Bump the revision whenever the prompt, model or key layout changes
+# to drop old entries.
+REFACTOR_CACHE_REVISION = 3
+REFACTOR_CACHE_SECONDS = 7 * 24 * 60 * 60
+refactor_queue: asyncio.Queue = asyncio.Queue(maxsize=REFACTOR_QUEUE_SIZE)
+
+SuggestionType = Literal["refactor", "optimize", "document", "style", "security"]
+SUGGESTION_TYPES = frozenset(get_args(SuggestionType))
+# Rendered once; RefactorRequest has already rejected any other type
+SUGGESTION_PROMPTS = {suggestion_type: get_suggestion_prompt(suggestion_type)
+                      for suggestion_type in SUGGESTION_TYPES}
 
 class RefactorRequest(BaseModel):
     """Request model for refactor endpoint"""
     code: str = Field(..., description="The code to refactor")
-    suggestion_type: str = Field(default="refactor", description="Type of refactoring")
+    suggestion_type: SuggestionType = Field(default="refactor", description="Type of refactoring")
     language: str = Field(default="python", description="Programming language")
     
-    class Config:
-        schema_extra = {
+    model_config = ConfigDict(
+        frozen=True,
+        json_schema_extra={
             "example": {
                 "code": "def add(a, b):\n    return a + b\n\ndef subtract(a, b):\n    return a - b",
                 "suggestion_type": "refactor",
                 "language": "python"
             }
         }
+    )
+
+class RefactorTaskResponse(BaseModel):
+    """Response model for a submitted refactor task"""
+    success: bool
+    session_id: str
+    status: str
+    status_url: str
+    message: str
 
 class RefactorResponse(BaseModel):
-    """Response model for refactor endpoint"""
+    """Response model for refactor task status"""
     success: bool
+    status: str
     refactored_main: Optional[str] = None
     utility_modules: Optional[Dict[str, str]] = None
     backup_file: Optional[str] = None
@@ -115,6 +280,8 @@ class RefactorResponse(BaseModel):
 
 class PaymentRequest(BaseModel):
     """Request model for payment processing"""
+    model_config = ConfigDict(frozen=True)
+    
     amount: int = Field(..., description="Amount in cents")
     currency: str = Field(default="usd", description="Currency code")
     description: str = Field(default="Refactor Agent API Credits", description="Payment description")
@@ -127,6 +294,17 @@ class PaymentResponse(BaseModel):
     credits: Optional[int] = None
     message: str
 
+class PaymentConfirmation(BaseModel):
+    """A single API key / payment intent pair to confirm"""
+    model_config = ConfigDict(frozen=True)
+    
+    api_key: str
+    payment_intent_id: str
+
+class BatchConfirmRequest(BaseModel):
+    """Request model for confirming several payments at once"""
+    items: List[PaymentConfirmation] = Field(..., description="Payments to confirm")
+
 class UsageResponse(BaseModel):
     """Response model for usage tracking"""
     api_key: str
@@ -135,93 +313,218 @@ class UsageResponse(BaseModel):
     created_at: str
     last_used: Optional[str] = None
 
+# Session ids are drawn from a shared buffer of random bytes, refilled
+# 256 bytes (16 ids) at a time, so most ids cost no getrandom() call
+_RANDOM_REFILL_BYTES = 256
+_random_buffer = bytearray()
+_random_lock = threading.Lock()
+
+def new_session_id() -> str:
+    """Return a fresh 128-bit hex session id"""
+    with _random_lock:
+        if not _random_buffer:
+            _random_buffer.extend(secrets.token_bytes(_RANDOM_REFILL_BYTES))
+        chunk = _random_buffer[-16:]
+        del _random_buffer[-16:]
+    return chunk.hex()
+
 def generate_api_key() -> str:
     """Generate a unique API key"""
-    return f"rfa_{uuid.uuid4().hex[:32]}"
+    return f"rfa_{secrets.token_urlsafe(24)}"
 
-def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Verify API key and check usage limits"""
+# Bearer tokens recently found not to exist, so scans of random keys are
+# answered for a second without another Redis lookup
+UNKNOWN_KEY_CACHE_SECONDS = 1.0
+UNKNOWN_KEY_CACHE_MAX_ENTRIES = 10000
+unknown_keys: Dict[str, float] = {}
+
+async def load_api_key(credentials: HTTPAuthorizationCredentials) -> tuple:
+    """Look up a bearer API key, rejecting unknown or expired keys"""
     if not credentials:
         raise HTTPException(status_code=401, detail="API key required")
     
     api_key = credentials.credentials
-    
-    if api_key not in api_keys:
+    now = time.monotonic()
+    if unknown_keys.get(api_key, 0.0) > now:
         raise HTTPException(status_code=401, detail="Invalid API key")
     
-    key_info = api_keys[api_key]
+    # Only the fields auth needs; every real record has a credits field
+    credits, expires_at_ns = await redis_client.hmget(api_key_record(api_key), "credits", "expires_at_ns")
+    
+    if credits is None:
+        if len(unknown_keys) >= UNKNOWN_KEY_CACHE_MAX_ENTRIES:
+            unknown_keys.clear()
+        unknown_keys[api_key] = now + UNKNOWN_KEY_CACHE_SECONDS
+        raise HTTPException(status_code=401, detail="Invalid API key")
     
-    # Check if key is expired
-    if key_info.get("expires_at") and datetime.now() > key_info["expires_at"]:
+    # Check if key is expired (timestamps are stored as integer epoch nanoseconds)
+    if expires_at_ns and time.time_ns() > int(expires_at_ns):
         raise HTTPException(status_code=401, detail="API key expired")
     
-    # Check credit balance
-    if key_info.get("credits", 0) <= 0:
-        raise HTTPException(status_code=402, detail="Insufficient credits")
+    return api_key, {"credits": credits, "expires_at_ns": expires_at_ns}
+
+async def rate_limit(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """
+    Reject bearers that exceed RATE_LIMIT_PER_MINUTE requests in the current window.
+
+    Runs before the API key lookup so floods are turned away with one round-trip.
+    """
+    if not credentials:
+        raise HTTPException(status_code=401, detail="API key required")
+    
+    now = time.time()
+    window = int(now // RATE_LIMIT_WINDOW_SECONDS)
+    key = f"{KEY_PREFIX}ratelimit:{credentials.credentials}:{window}"
+    
+    # INCR and EXPIRE in one round-trip; each window gets its own key
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.incr(key)
+        pipe.expire(key, RATE_LIMIT_WINDOW_SECONDS)
+        count, _ = await pipe.execute()
     
+    if count > RATE_LIMIT_PER_MINUTE:
+        retry_after = RATE_LIMIT_WINDOW_SECONDS - int(now % RATE_LIMIT_WINDOW_SECONDS)
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+async def authenticate_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Verify API key without requiring remaining credits"""
+    api_key, _ = await load_api_key(credentials)
     return api_key
 
-async def refactor_code_async(code: str, suggestion_type: str) -> Dict[str, Any]:
-    """Async wrapper for refactor functionality"""
-    loop = asyncio.get_event_loop()
+async def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Verify API key and check usage limits"""
+    api_key, key_info = await load_api_key(credentials)
     
-    def refactor_sync():
-        try:
-            # Import required modules
-            from io import StringIO
-            from contextlib import redirect_stdout
-            
-            # Get suggestion prompt
-            suggestion_prompt = get_suggestion_prompt(suggestion_type)
-            
-            # Prepare message
-            message = f"""
-            {suggestion_prompt}
+    # Check credit balance
+    if int(key_info.get("credits", 0)) <= 0:
+        raise HTTPException(status_code=402, detail="Insufficient credits")
+    
+    return api_key
 
+# Static parts of the agent prompt; the suggestion and then the code follow
+# the fixed instructions, so requests share a long cacheable prefix
+_PROMPT_PREFIX = """
             Return the structured JSON output with these exact keys:
             - 'refactored_main': The improved version of the original file
             - 'backup_file': The old code to be saved to a separate file
             - 'utility_modules': Dictionary of extracted utility modules (filename -> code)
 
+            """
+_PROMPT_MIDDLE = """
+
             Code to improve:
             ```python
-            {code}
+            """
+_PROMPT_SUFFIX = """
             ```
             """
+
+def refactor_sync(code: str, suggestion_type: str) -> Dict[str, Any]:
+    """Run one refactor through a fresh agent pair and return the parsed preview"""
+    try:
+        # Prepare message
+        # One join of known parts; no format-spec parsing or f-string temporaries
+        message = "".join((
+            _PROMPT_PREFIX, SUGGESTION_PROMPTS[suggestion_type], _PROMPT_MIDDLE, code, _PROMPT_SUFFIX
+        ))
+        
+        # Take the assistant's final reply straight from the chat history;
+        # fresh agents keep concurrent requests from sharing a conversation
+        reply = run_chat(message, agents=create_agents())
+        
+        # Raises ValueError when the reply carries no JSON object
+        return parse_agent_output(reply)
             
-            # Capture stdout to get the agent's response
-            output_buffer = StringIO()
-            with redirect_stdout(output_buffer):
-                user.initiate_chat(assistant, message=message)
-            
-            # Get the captured output
-            captured_output = output_buffer.getvalue()
-            
-            # Parse the JSON response
-            json_start = captured_output.find('```json')
-            if json_start == -1:
-                json_start = captured_output.find('{')
-            
-            json_end = captured_output.rfind('```')
-            if json_end == -1:
-                json_end = captured_output.rfind('}') + 1
-            
-            if json_start != -1 and json_end != -1:
-                json_str = captured_output[json_start:json_end].replace('```json', '').replace('```', '').strip()
-                parsed_response = json.loads(json_str)
-                return parsed_response
-            else:
-                raise Exception("No JSON block found in response")
-                
+    except Exception:
+        logger.exception("Refactor error")
+        raise
+
+async def refactor_code_async(code: str, suggestion_type: str) -> Dict[str, Any]:
+    """Async wrapper for refactor functionality"""
+    return await anyio.to_thread.run_sync(refactor_sync, code, suggestion_type)
+
+async def refactor_worker():
+    """Run queued refactor jobs one at a time on the thread pool"""
+    while True:
+        code, suggestion_type, future = await refactor_queue.get()
+        try:
+            # Skip jobs whose request was cancelled while they waited
+            if future.cancelled():
+                continue
+            result = await refactor_code_async(code, suggestion_type)
         except Exception as e:
-            logger.error(f"Refactor error: {e}")
-            raise e
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            refactor_queue.task_done()
+
+async def enqueue_refactor(code: str, suggestion_type: str) -> asyncio.Future:
+    """
+    Queue a refactor for the worker pool.
+
+    A full queue gets REFACTOR_ADMISSION_TIMEOUT seconds to free a slot, which
+    absorbs short bursts without letting callers pile up.
+
+    Returns:
+        Future resolved with the parsed agent result
+
+    Raises:
+        asyncio.QueueFull: If no slot frees up in time
+    """
+    future = asyncio.get_running_loop().create_future()
+    item = (code, suggestion_type, future)
+    try:
+        refactor_queue.put_nowait(item)
+    except asyncio.QueueFull:
+        try:
+            await asyncio.wait_for(refactor_queue.put(item), timeout=REFACTOR_ADMISSION_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise asyncio.QueueFull from None
+    return future
+
+def task_record(session_id: str) -> str:
+    """Storage key for a refactor task's status"""
+    return f"{KEY_PREFIX}task:{session_id}"
+
+async def store_task(session_id: str, task: Dict[str, Any]):
+    """Save a refactor task's status; results are compressed like cached ones"""
+    await blob_client.set(task_record(session_id), compress_blob(json_dumps(task)), ex=TASK_TTL_SECONDS)
+
+async def run_refactor_task(credit: AsyncExitStack, session_id: str, task: Dict[str, Any],
+                            cache_key: str, future: asyncio.Future):
+    """Wait for a queued refactor, settle its credit and publish the outcome"""
+    try:
+        async with credit:
+            result = await future
+    except Exception as e:
+        logger.error(f"Refactor session {session_id} failed: {e}")
+        task.update(status="error", message=f"Refactoring failed: {str(e)}")
+        await store_task(session_id, task)
+        return
     
-    return await loop.run_in_executor(thread_pool, refactor_sync)
+    # Remember the result for identical requests
+    await blob_client.set(cache_key, compress_blob(json_dumps(result)), ex=REFACTOR_CACHE_SECONDS)
+    task.update(status="done", message="Code refactored successfully", result=result)
+    await store_task(session_id, task)
+    logger.info("Refactor session %s done", session_id)
 
 @app.post("/api/v1/payment/create-intent", response_model=PaymentResponse)
-async def create_payment_intent(request: PaymentRequest):
-    """Create a Stripe payment intent and generate API key"""
+async def create_payment_intent(request: PaymentRequest,
+                                idempotency_key: Optional[str] = Header(default=None, max_length=200)):
+    """
+    Create a Stripe payment intent and generate API key
+
+    Clients should send an Idempotency-Key header that is unique per purchase
+    and resend it when retrying; a retry within IDEMPOTENCY_WINDOW_SECONDS
+    gets the same API key and payment intent instead of new ones.
+    """
     try:
         if not stripe.api_key:
             raise HTTPException(status_code=503, detail="Payment processing unavailable")
@@ -234,30 +537,47 @@ async def create_payment_intent(request: PaymentRequest):
         }
         credits = credits_mapping.get(request.amount, request.amount // 100)
         
-        # Create payment intent
-        intent = stripe.PaymentIntent.create(
+        # Generate API key; the webhook finds the record through the same key.
+        # A retried attempt reuses the key its first try stored (SET NX, so
+        # concurrent retries agree on one), which keeps the intent's metadata
+        # identical and lets Stripe hand back the same intent.
+        api_key = generate_api_key()
+        retry = False
+        if idempotency_key:
+            attempt_record = f"{KEY_PREFIX}idempotency:create-intent:{idempotency_key}"
+            if not await redis_client.set(attempt_record, api_key, ex=IDEMPOTENCY_WINDOW_SECONDS, nx=True):
+                api_key = await redis_client.get(attempt_record) or api_key
+                retry = True
+            stripe_idempotency_key = f"pi_{idempotency_key}"
+        else:
+            stripe_idempotency_key = f"pi_{secrets.token_hex(16)}"
+        
+        # Create payment intent (async SDK call, no worker thread needed)
+        intent = await stripe.PaymentIntent.create_async(
+            idempotency_key=stripe_idempotency_key,
             amount=request.amount,
             currency=request.currency,
             description=request.description,
             metadata={
                 "service": "refactor_agent",
                 "credits": str(credits),
-                "api_key": generate_api_key()
+                "api_key": api_key
             }
         )
         
-        # Generate API key
-        api_key = generate_api_key()
-        
-        # Store API key info (pending payment confirmation)
-        api_keys[api_key] = {
-            "credits": 0,  # Will be activated after payment
-            "total_requests": 0,
-            "created_at": datetime.now(),
-            "payment_intent": intent.id,
-            "pending_credits": credits,
-            "status": "pending"
-        }
+        # Store API key info (pending payment confirmation). A retry leaves an
+        # existing record alone: its payment may already have activated it.
+        if not (retry and await redis_client.exists(api_key_record(api_key))):
+            await redis_client.hset(api_key_record(api_key), mapping={
+                "credits": 0,  # Will be activated after payment
+                "total_requests": 0,
+                "created_at": time.time_ns(),
+                "payment_intent": intent.id,
+                "idempotency_key": stripe_idempotency_key,
+                "pending_credits": credits,
+                "status": "pending"
+            })
+            await redis_client.expire(api_key_record(api_key), PENDING_KEY_TTL_SECONDS)
         
         return PaymentResponse(
             success=True,
@@ -267,10 +587,62 @@ async def create_payment_intent(request: PaymentRequest):
             message="Payment intent created successfully"
         )
         
+    except stripe.error.IdempotencyError as e:
+        # Same Idempotency-Key reused with a different amount or description
+        raise HTTPException(status_code=409, detail=f"Idempotency-Key reused with different parameters: {e}")
     except Exception as e:
         logger.error(f"Payment creation error: {e}")
         raise HTTPException(status_code=500, detail=f"Payment creation failed: {str(e)}")
 
+async def get_intent_cached(payment_intent_id: str) -> Dict[str, Any]:
+    """Retrieve a payment intent, reusing the cached copy once it's final"""
+    cache_key = f"{KEY_PREFIX}stripe_pi:{payment_intent_id}"
+    cached = await redis_client.get(cache_key)
+    if cached:
+        return json_loads(cached)
+
+    async with stripe_semaphore:
+        intent = await stripe.PaymentIntent.retrieve_async(payment_intent_id)
+
+    # Pending intents are fetched fresh every time so status changes show up
+    if intent["status"] in STRIPE_FINAL_STATUSES:
+        await redis_client.set(cache_key, json_dumps(intent), ex=STRIPE_INTENT_CACHE_SECONDS)
+    return intent
+
+async def activate_api_key(api_key: str, payment_intent_id: str) -> bool:
+    """
+    Move a pending API key's credits into its balance once its payment succeeds.
+
+    Returns False if the key doesn't exist or belongs to another payment intent.
+    """
+    record = api_key_record(api_key)
+    # Confirm and the webhook can both fire and both read "pending". WATCH
+    # makes the status check and the credit one atomic step: if anything
+    # writes the key in between, EXEC aborts and the check runs again, so the
+    # credits land exactly once and nothing is left half-applied on failure
+    async with redis_client.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(record)
+                key_info = await pipe.hgetall(record)
+                if not key_info or key_info.get("payment_intent") != payment_intent_id:
+                    return False
+                if key_info.get("status") == "active":
+                    return True
+
+                # Top up, activate and (since paid keys don't expire) persist together
+                pipe.multi()
+                pipe.hincrby(record, "credits", int(key_info["pending_credits"]))
+                pipe.hset(record, mapping={
+                    "status": "active",
+                    "activated_at": time.time_ns()
+                })
+                pipe.persist(record)
+                await pipe.execute()
+                return True
+            except WatchError:
+                continue
+
 @app.post("/api/v1/payment/confirm")
 async def confirm_payment(api_key: str, payment_intent_id: str):
     """Confirm payment and activate API key"""
@@ -279,20 +651,14 @@ async def confirm_payment(api_key: str, payment_intent_id: str):
             raise HTTPException(status_code=503, detail="Payment processing unavailable")
         
         # Verify payment intent
-        intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+        intent = await get_intent_cached(payment_intent_id)
         
-        if intent.status != "succeeded":
+        if intent["status"] != "succeeded":
             raise HTTPException(status_code=400, detail="Payment not confirmed")
         
         # Activate API key
-        if api_key in api_keys:
-            key_info = api_keys[api_key]
-            if key_info["payment_intent"] == payment_intent_id:
-                key_info["credits"] = key_info["pending_credits"]
-                key_info["status"] = "active"
-                key_info["activated_at"] = datetime.now()
-                
-                return {"success": True, "message": "API key activated successfully"}
+        if await activate_api_key(api_key, payment_intent_id):
+            return {"success": True, "message": "API key activated successfully"}
         
         raise HTTPException(status_code=400, detail="Invalid API key or payment intent")
         
@@ -300,118 +666,407 @@ async def confirm_payment(api_key: str, payment_intent_id: str):
         logger.error(f"Payment confirmation error: {e}")
         raise HTTPException(status_code=500, detail=f"Payment confirmation failed: {str(e)}")
 
-@app.post("/api/v1/refactor", response_model=RefactorResponse)
+@app.post("/api/v1/payment/confirm-batch")
+async def confirm_payment_batch(request: BatchConfirmRequest):
+    """Confirm several payments, fetching their intents from Stripe in parallel"""
+    if not stripe.api_key:
+        raise HTTPException(status_code=503, detail="Payment processing unavailable")
+    
+    if len(request.items) > MAX_BATCH_CONFIRMATIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BATCH_CONFIRMATIONS} payments can be confirmed per request"
+        )
+    
+    # Stripe latency dominates, so overlap the round-trips
+    intents = await asyncio.gather(
+        *(get_intent_cached(item.payment_intent_id) for item in request.items),
+        return_exceptions=True
+    )
+    
+    results = []
+    for item, intent in zip(request.items, intents):
+        result = {"api_key": item.api_key, "payment_intent_id": item.payment_intent_id, "activated": False}
+        if isinstance(intent, Exception):
+            logger.error(f"Payment confirmation error for {item.payment_intent_id}: {intent}")
+            result["message"] = f"Payment confirmation failed: {str(intent)}"
+        elif intent["status"] != "succeeded":
+            result["message"] = "Payment not confirmed"
+        elif await activate_api_key(item.api_key, item.payment_intent_id):
+            result["activated"] = True
+            result["message"] = "API key activated successfully"
+        else:
+            result["message"] = "Invalid API key or payment intent"
+        results.append(result)
+    
+    return {
+        "success": all(result["activated"] for result in results),
+        "results": results
+    }
+
+@asynccontextmanager
+async def credit_guard(api_key: str):
+    """
+    Reserve one credit for a refactor and settle it when the block exits.
+
+    The credit is only spent if the block completes; any exception releases
+    the reservation instead. The session record is always removed.
+
+    Raises:
+        HTTPException: 402 if every remaining credit is already reserved
+    """
+    record = api_key_record(api_key)
+    reservations = reservation_record(api_key)
+    session_id = new_session_id()
+    now = time.time()
+    
+    # Each reservation is scored by its expiry, so one leaked by a killed
+    # worker is pruned here instead of holding a credit forever. MULTI makes
+    # prune, add and count a single step: concurrent requests can't both
+    # count themselves into the same credit
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.zremrangebyscore(reservations, "-inf", now)
+        pipe.zadd(reservations, {session_id: now + RESERVATION_TTL_SECONDS})
+        pipe.expire(reservations, RESERVATION_TTL_SECONDS)
+        pipe.zcard(reservations)
+        pipe.hget(record, "credits")
+        *_, reserved, credits = await pipe.execute()
+    if int(credits or 0) < reserved:
+        await redis_client.zrem(reservations, session_id)
+        raise HTTPException(status_code=402, detail="Insufficient credits")
+    
+    try:
+        yield session_id
+    except BaseException:
+        await redis_client.zrem(reservations, session_id)
+        raise
+    else:
+        # Spend the credit and drop the reservation together
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hincrby(record, "credits", -1)
+            pipe.zrem(reservations, session_id)
+            await pipe.execute()
+    finally:
+        if TRACE_SESSIONS:
+            await redis_client.delete(session_record(session_id))
+
+@app.post("/api/v1/refactor", response_model=RefactorTaskResponse, status_code=202,
+          dependencies=[Depends(rate_limit)])
 async def refactor_code(request: RefactorRequest, api_key: str = Depends(verify_api_key)):
-    """Refactor code using the AI agent"""
+    """
+    Submit code to the AI agent for refactoring.
+
+    The refactor runs in the background; poll the returned status_url for the result.
+    """
     try:
         # Check OpenAI API key
         if not os.getenv("OPENAI_API_KEY"):
             raise HTTPException(status_code=503, detail="OpenAI API key not configured")
         
-        # Generate session ID
-        session_id = str(uuid.uuid4())
+        record = api_key_record(api_key)
         
-        # Track usage
-        key_info = api_keys[api_key]
-        key_info["total_requests"] += 1
-        key_info["credits"] -= 1
-        key_info["last_used"] = datetime.now()
+        # Serve this key's repeats of an already refactored snippet without
+        # another LLM run; a hit is still a refactor, so it spends a credit
+        cache_key = refactor_cache_key(api_key, request.code, request.suggestion_type)
+        cached = await blob_client.get(cache_key)
+        if cached:
+            async with credit_guard(api_key) as session_id:
+                total_requests = await record_request(record)
+                await store_task(session_id, {
+                    "api_key": api_key,
+                    "status": "done",
+                    "message": "Code refactored successfully (cached result)",
+                    "usage_count": total_requests,
+                    "result": json_loads(decompress_blob(cached))
+                })
+            return RefactorTaskResponse(
+                success=True,
+                session_id=session_id,
+                status="done",
+                status_url=f"/api/v1/refactor/status/{session_id}",
+                message="Code refactored successfully (cached result)"
+            )
         
-        # Store session info
-        active_sessions[session_id] = {
-            "api_key": api_key,
-            "started_at": datetime.now(),
-            "request": request.dict()
-        }
-        
-        # Validate suggestion type
-        valid_types = ["refactor", "optimize", "document", "style", "security"]
-        if request.suggestion_type not in valid_types:
-            raise HTTPException(status_code=400, detail=f"Invalid suggestion_type. Must be one of: {valid_types}")
-        
-        # Refactor the code
-        result = await refactor_code_async(request.code, request.suggestion_type)
+        # The credit is only spent if the refactor succeeds; pop_all hands the
+        # reservation over to the background task once the job is queued
+        async with AsyncExitStack() as stack:
+            session_id = await stack.enter_async_context(credit_guard(api_key))
+            total_requests = await record_request(record)
+            
+            logger.info("Refactor session %s started (%s, %d chars)",
+                        session_id, request.suggestion_type, len(request.code))
+            if TRACE_SESSIONS:
+                # Store session info; the TTL cleans up sessions a crash never popped
+                # Only a summary of the request: copying the code would double its memory
+                session = {
+                    "api_key": api_key,
+                    "started_at": time.time_ns(),
+                    "code_len": len(request.code),
+                    "suggestion_type": request.suggestion_type
+                }
+                if logger.isEnabledFor(logging.DEBUG):
+                    session["request"] = request.model_dump(exclude={"code"})
+                await redis_client.set(session_record(session_id), json_dumps(session), ex=SESSION_TTL_SECONDS)
+            
+            # Queue the refactor
+            try:
+                future = await enqueue_refactor(request.code, request.suggestion_type)
+            except asyncio.QueueFull:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Refactor service is busy, please retry shortly",
+                    headers={"Retry-After": str(REFACTOR_RETRY_AFTER_SECONDS)}
+                )
+            
+            task = {
+                "api_key": api_key,
+                "status": "pending",
+                "message": "Refactor queued",
+                "usage_count": total_requests
+            }
+            await store_task(session_id, task)
+            credit = stack.pop_all()
         
-        # Clean up session
-        active_sessions.pop(session_id, None)
+        background = asyncio.create_task(run_refactor_task(credit, session_id, task, cache_key, future))
+        background_tasks.add(background)
+        background.add_done_callback(background_tasks.discard)
         
-        return RefactorResponse(
+        return RefactorTaskResponse(
             success=True,
-            refactored_main=result.get("refactored_main"),
-            utility_modules=result.get("utility_modules"),
-            backup_file=result.get("backup_file"),
-            message="Code refactored successfully",
-            usage_count=key_info["total_requests"],
-            session_id=session_id
+            session_id=session_id,
+            status="pending",
+            status_url=f"/api/v1/refactor/status/{session_id}",
+            message="Refactor queued"
         )
         
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Refactor error: {e}")
-        # Clean up session on error
-        active_sessions.pop(session_id, None)
         raise HTTPException(status_code=500, detail=f"Refactoring failed: {str(e)}")
 
-@app.get("/api/v1/usage", response_model=UsageResponse)
+async def stream_refactor_result(session_id: str, task: Dict[str, Any]):
+    """
+    Yield a finished task's RefactorResponse JSON piece by piece.
+
+    Each code string is encoded on its own, so the full response body never
+    has to exist as one buffer next to the decoded result.
+    """
+    result = task["result"]
+    yield b'{"success":true,"status":"done","refactored_main":'
+    yield json_dumps(result.get("refactored_main"))
+    
+    modules = result.get("utility_modules")
+    if modules is None:
+        yield b',"utility_modules":null'
+    else:
+        yield b',"utility_modules":{'
+        for index, (name, code) in enumerate(modules.items()):
+            yield b"".join((b"," if index else b"", json_dumps(name), b":"))
+            yield json_dumps(code)
+        yield b"}"
+    
+    yield b',"backup_file":'
+    yield json_dumps(result.get("backup_file"))
+    yield b"".join((
+        b',"message":', json_dumps(task["message"]),
+        b',"usage_count":', json_dumps(task["usage_count"]),
+        b',"session_id":', json_dumps(session_id), b"}"
+    ))
+
+@app.get("/api/v1/refactor/status/{session_id}", response_model=RefactorResponse)
+async def get_refactor_status(session_id: str, api_key: str = Depends(authenticate_api_key)):
+    """Get the status, and once done the result, of a refactor task"""
+    blob = await blob_client.get(task_record(session_id))
+    task = json_loads(decompress_blob(blob)) if blob else None
+    
+    # Tasks are only visible to the key that submitted them
+    if not task or task["api_key"] != api_key:
+        raise HTTPException(status_code=404, detail="Refactor task not found")
+    
+    # Results can be hundreds of KB; stream them instead of building one body
+    if task["status"] == "done":
+        return StreamingResponse(stream_refactor_result(session_id, task), media_type="application/json")
+    
+    result = task.get("result") or {}
+    return RefactorResponse(
+        success=task["status"] != "error",
+        status=task["status"],
+        refactored_main=result.get("refactored_main"),
+        utility_modules=result.get("utility_modules"),
+        backup_file=result.get("backup_file"),
+        message=task["message"],
+        usage_count=task["usage_count"],
+        session_id=session_id
+    )
+
+# Short-lived per-key cache for the usage endpoint, which dashboards poll
+USAGE_PATH = "/api/v1/usage"
+USAGE_CACHE_MAX_ENTRIES = 10000
+usage_cache: Dict[str, tuple] = {}
+
+@app.middleware("http")
+async def cache_usage_responses(request: Request, call_next):
+    """Serve repeated usage polls from memory, falling back to stale data on errors"""
+    if request.method != "GET" or request.url.path != USAGE_PATH:
+        return await call_next(request)
+    
+    auth = request.headers.get("authorization")
+    if not auth:
+        return await call_next(request)
+    
+    now = time.monotonic()
+    cached = usage_cache.get(auth)
+    if cached and cached[0] > now:
+        return Response(content=cached[1], headers=cached[2])
+    
+    try:
+        response = await call_next(request)
+    except Exception as e:
+        if not cached:
+            raise
+        logger.warning(f"Serving stale usage data after error: {e}")
+        response = None
+    
+    if response is None or response.status_code >= 500:
+        if cached:
+            return Response(content=cached[1],
+                            headers={**cached[2], "Warning": '110 - "Response is stale"'})
+        return response
+    
+    if response.status_code != 200:
+        return response
+    
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    if len(usage_cache) >= USAGE_CACHE_MAX_ENTRIES:
+        # Drop expired entries; start over if everything is still fresh
+        for key in [key for key, entry in usage_cache.items() if entry[0] <= now]:
+            del usage_cache[key]
+        if len(usage_cache) >= USAGE_CACHE_MAX_ENTRIES:
+            usage_cache.clear()
+    # Keep the headers too: the body may already be compressed by an inner middleware
+    headers = dict(response.headers)
+    usage_cache[auth] = (now + CACHE_TTL_SECONDS["short"], body, headers)
+    
+    return Response(content=body, status_code=200, headers=headers)
+
+@app.get(USAGE_PATH, response_model=UsageResponse)
 async def get_usage(api_key: str = Depends(verify_api_key)):
     """Get usage statistics for an API key"""
-    key_info = api_keys[api_key]
+    key_info = await redis_client.hgetall(api_key_record(api_key))
     
     return UsageResponse(
         api_key=api_key,
-        total_requests=key_info["total_requests"],
-        remaining_credits=key_info["credits"],
-        created_at=key_info["created_at"].isoformat(),
-        last_used=key_info["last_used"].isoformat() if key_info.get("last_used") else None
+        total_requests=int(key_info["total_requests"]),
+        remaining_credits=int(key_info["credits"]),
+        created_at=format_timestamp(key_info["created_at"]),
+        last_used=format_timestamp(key_info.get("last_used"))
     )
 
-@app.get("/api/v1/health")
-async def health_check():
-    """Health check endpoint"""
-    return {
+# Response cache policies (seconds) for endpoints whose output rarely changes
+CACHE_TTL_SECONDS = {
+    "short": 5,
+    "normal": 30,
+    "long": 300
+}
+
+@lru_cache(maxsize=1)
+def _health_payload(bucket: int) -> bytes:
+    """Encoded health response, rebuilt once per cache bucket"""
+    return json_dumps({
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
         "version": "1.0.0",
         "openai_configured": bool(os.getenv("OPENAI_API_KEY")),
         "stripe_configured": bool(stripe.api_key)
-    }
+    })
+
+@app.get("/api/v1/health")
+async def health_check():
+    """Health check endpoint"""
+    bucket = int(time.monotonic() // CACHE_TTL_SECONDS["short"])
+    return Response(content=_health_payload(bucket), media_type="application/json")
+
+PRICING = {
+    "plans": {
+        "starter": {
+            "price": 990,  # $9.90
+            "credits": 10,
+            "description": "10 refactor requests - Perfect for trying the service",
+            "price_per_refactor": "$0.99",
+            "best_for": "Individual developers, small projects"
+        },
+        "professional": {
+            "price": 2990,  # $29.90
+            "credits": 50,
+            "description": "50 refactor requests - Most popular plan",
+            "price_per_refactor": "$0.60",
+            "best_for": "Professional developers, medium projects",
+            "savings": "40% vs Starter"
+        },
+        "enterprise": {
+            "price": 9990,  # $99.90
+            "credits": 250,
+            "description": "250 refactor requests - Maximum value",
+            "price_per_refactor": "$0.40",
+            "best_for": "Teams, large codebases, frequent refactoring",
+            "savings": "60% vs Starter"
+        }
+    },
+    "currency": "usd",
+    "note": "Prices are in cents. 1 credit = 1 refactor request. Credits never expire."
+}
+
+# Default pricing, encoded once at import. Operators can override it for every
+# worker by storing JSON under "<prefix>pricing"; workers re-read it every
+# CACHE_TTL_SECONDS["long"] seconds.
+PRICING_JSON = json_dumps(PRICING)
+PRICING_CACHE_CONTROL = f"public, max-age={CACHE_TTL_SECONDS['long']}"
+
+def entity_tag(body: bytes) -> str:
+    """Strong ETag for a response body"""
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+# Current pricing body, its ETag and when to check Redis again
+pricing_cache = {"body": PRICING_JSON, "etag": entity_tag(PRICING_JSON), "refresh_at": 0.0}
+
+async def current_pricing() -> Dict[str, Any]:
+    """Return the cached pricing entry, refreshing it from Redis when due"""
+    now = time.monotonic()
+    if now >= pricing_cache["refresh_at"]:
+        try:
+            override = await redis_client.get(f"{KEY_PREFIX}pricing")
+        except Exception as e:
+            logger.warning(f"Could not load pricing from storage: {e}")
+            override = None
+        body = override.encode() if override else PRICING_JSON
+        if body != pricing_cache["body"]:
+            pricing_cache.update(body=body, etag=entity_tag(body))
+        pricing_cache["refresh_at"] = now + CACHE_TTL_SECONDS["long"]
+    return pricing_cache
 
 @app.get("/api/v1/pricing")
-async def get_pricing():
+async def get_pricing(request: Request):
     """Get pricing information"""
-    return {
-        "plans": {
-            "starter": {
-                "price": 990,  # $9.90
-                "credits": 10,
-                "description": "10 refactor requests - Perfect for trying the service",
-                "price_per_refactor": "$0.99",
-                "best_for": "Individual developers, small projects"
-            },
-            "professional": {
-                "price": 2990,  # $29.90
-                "credits": 50,
-                "description": "50 refactor requests - Most popular plan",
-                "price_per_refactor": "$0.60",
-                "best_for": "Professional developers, medium projects",
-                "savings": "40% vs Starter"
-            },
-            "enterprise": {
-                "price": 9990,  # $99.90
-                "credits": 250,
-                "description": "250 refactor requests - Maximum value",
-                "price_per_refactor": "$0.40",
-                "best_for": "Teams, large codebases, frequent refactoring",
-                "savings": "60% vs Starter"
-            }
-        },
-        "currency": "usd",
-        "note": "Prices are in cents. 1 credit = 1 refactor request. Credits never expire."
-    }
+    pricing = await current_pricing()
+    headers = {"Cache-Control": PRICING_CACHE_CONTROL, "ETag": pricing["etag"]}
+    
+    if request.headers.get("if-none-match") == pricing["etag"]:
+        return Response(status_code=304, headers=headers)
+    
+    return Response(content=pricing["body"], media_type="application/json", headers=headers)
+
+async def activate_from_webhook(api_key: str, payment_intent_id: str, credits: int):
+    """Activate a paid API key after the webhook has been acknowledged"""
+    try:
+        # Tops up with HINCRBY, at most once
+        if await activate_api_key(api_key, payment_intent_id):
+            logger.info(f"Activated API key {api_key} with {credits} credits")
+    except Exception as e:
+        logger.error(f"Webhook activation error for {payment_intent_id}: {e}")
 
 @app.post("/api/v1/payment/webhook")
-async def stripe_webhook(request: Request):
+async def stripe_webhook(request: Request, background_tasks: BackgroundTasks):
     """Handle Stripe webhooks for payment confirmation"""
     try:
         webhook_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
@@ -425,10 +1080,20 @@ async def stripe_webhook(request: Request):
         if not signature:
             raise HTTPException(status_code=400, detail="Missing Stripe signature")
         
-        # Verify webhook signature
-        event = stripe.Webhook.construct_event(
-            payload, signature, webhook_secret
-        )
+        # Verify webhook signature, then parse the event with our own decoder;
+        # the handler only needs plain dict access, not StripeObject wrappers
+        if len(payload) > WEBHOOK_OFFLOAD_BYTES:
+            # HMAC-SHA256 over a large body is long enough to stall other requests
+            await run_in_threadpool(
+                stripe.WebhookSignature.verify_header, payload.decode("utf-8"), signature, webhook_secret,
+                stripe.Webhook.DEFAULT_TOLERANCE
+            )
+            event = await run_in_threadpool(json_loads, payload)
+        else:
+            stripe.WebhookSignature.verify_header(
+                payload.decode("utf-8"), signature, webhook_secret, stripe.Webhook.DEFAULT_TOLERANCE
+            )
+            event = json_loads(payload)
         
         logger.info(f"Received webhook event: {event['type']}")
         
@@ -438,12 +1103,9 @@ async def stripe_webhook(request: Request):
             api_key = payment_intent.get("metadata", {}).get("api_key")
             credits = int(payment_intent.get("metadata", {}).get("credits", 0))
             
-            if api_key and api_key in api_keys:
-                # Activate the API key
-                api_keys[api_key]["credits"] = credits
-                api_keys[api_key]["status"] = "active"
-                api_keys[api_key]["activated_at"] = datetime.now()
-                logger.info(f"Activated API key {api_key} with {credits} credits")
+            # Acknowledge Stripe first; activation runs after the response is sent
+            if api_key:
+                background_tasks.add_task(activate_from_webhook, api_key, payment_intent["id"], credits)
         
         return {"status": "success"}
         
@@ -451,198 +1113,27 @@ async def stripe_webhook(request: Request):
         logger.error(f"Webhook processing error: {e}")
         raise HTTPException(status_code=500, detail=f"Webhook processing failed: {str(e)}")
 
+# Landing page, read and gzipped once at import; served as-is on every request
+LANDING_HTML = (Path(__file__).parent / "static" / "landing.html").read_bytes()
+LANDING_GZ = gzip.compress(LANDING_HTML, 9)
+LANDING_VARIANTS = {
+    False: (LANDING_HTML, entity_tag(LANDING_HTML)),
+    True: (LANDING_GZ, entity_tag(LANDING_GZ))
+}
+
 @app.get("/", response_class=HTMLResponse)
-async def landing_page():
+async def landing_page(request: Request):
     """Landing page for the Refactor Agent API"""
-    html_content = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Refactor Agent API - AI-Powered Code Refactoring</title>
-        <meta charset="utf-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
-            body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; margin: 0; padding: 0; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: #333; }
-            .container { max-width: 1200px; margin: 0 auto; padding: 20px; }
-            .header { text-align: center; color: white; padding: 60px 0; }
-            .header h1 { font-size: 3.5em; margin-bottom: 20px; text-shadow: 2px 2px 4px rgba(0,0,0,0.3); }
-            .header p { font-size: 1.4em; margin-bottom: 30px; opacity: 0.9; }
-            .stats { background: rgba(255,255,255,0.1); padding: 30px; border-radius: 15px; margin: 40px 0; text-align: center; color: white; }
-            .stats h2 { margin-bottom: 20px; }
-            .stat-item { display: inline-block; margin: 0 30px; }
-            .stat-number { font-size: 2.5em; font-weight: bold; display: block; }
-            .content { background: white; border-radius: 20px; padding: 40px; margin: 20px 0; box-shadow: 0 10px 30px rgba(0,0,0,0.1); }
-            .pricing { display: flex; justify-content: space-around; gap: 30px; margin: 40px 0; flex-wrap: wrap; }
-            .plan { border: 2px solid #e0e0e0; border-radius: 15px; padding: 30px; text-align: center; flex: 1; min-width: 280px; transition: transform 0.3s ease; }
-            .plan:hover { transform: translateY(-5px); box-shadow: 0 15px 40px rgba(0,0,0,0.1); }
-            .plan.popular { border-color: #667eea; background: linear-gradient(135deg, #f8f9ff 0%, #e6eaff 100%); position: relative; }
-            .plan.popular::before { content: 'MOST POPULAR'; position: absolute; top: -10px; left: 50%; transform: translateX(-50%); background: #667eea; color: white; padding: 5px 20px; border-radius: 20px; font-size: 0.8em; font-weight: bold; }
-            .plan h3 { font-size: 1.8em; margin-bottom: 10px; color: #333; }
-            .plan .price { font-size: 3em; color: #667eea; margin: 20px 0; font-weight: bold; }
-            .plan .price small { font-size: 0.4em; color: #666; }
-            .plan .per-refactor { color: #666; font-size: 1.1em; margin-bottom: 20px; }
-            .plan ul { text-align: left; margin: 20px 0; list-style: none; padding: 0; }
-            .plan li { padding: 8px 0; border-bottom: 1px solid #f0f0f0; }
-            .plan li:before { content: '✓'; color: #28a745; font-weight: bold; margin-right: 10px; }
-            .plan button { background: #667eea; color: white; border: none; padding: 15px 30px; border-radius: 25px; cursor: pointer; font-size: 1.1em; font-weight: bold; margin-top: 20px; transition: background 0.3s ease; width: 100%; }
-            .plan button:hover { background: #5a6fd8; }
-            .features { margin: 40px 0; }
-            .features h2 { text-align: center; margin-bottom: 40px; font-size: 2.5em; }
-            .feature-grid { display: grid; grid-template-columns: repeat(auto-fit, minmax(300px, 1fr)); gap: 30px; }
-            .feature { padding: 30px; border: 1px solid #e0e0e0; border-radius: 15px; text-align: center; }
-            .feature-icon { font-size: 3em; margin-bottom: 20px; }
-            .cta { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; text-align: center; padding: 60px 40px; border-radius: 20px; margin: 40px 0; }
-            .cta h2 { font-size: 2.5em; margin-bottom: 20px; }
-            .cta button { background: white; color: #667eea; border: none; padding: 20px 40px; border-radius: 25px; cursor: pointer; font-size: 1.2em; font-weight: bold; margin: 20px 10px; }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <h1>🤖 Refactor Agent API</h1>
-                <p>Transform your code with AI-powered refactoring</p>
-                <p>Extract utilities • Optimize performance • Add documentation • Improve style • Enhance security</p>
-            </div>
-            
-            <div class="stats">
-                <h2>Trusted by 57+ developers in just 4 days!</h2>
-                <div class="stat-item">
-                    <span class="stat-number">57+</span>
-                    <span>GitHub Clones</span>
-                </div>
-                <div class="stat-item">
-                    <span class="stat-number">5</span>
-                    <span>Refactor Types</span>
-                </div>
-                <div class="stat-item">
-                    <span class="stat-number">API</span>
-                    <span>Ready</span>
-                </div>
-            </div>
-            
-            <div class="content">
-                <div class="features">
-                    <h2>🚀 Powerful AI Refactoring</h2>
-                    <div class="feature-grid">
-                        <div class="feature">
-                            <div class="feature-icon">🧠</div>
-                            <h3>Extract Utilities</h3>
-                            <p>Identify and extract reusable functions into organized modules</p>
-                        </div>
-                        <div class="feature">
-                            <div class="feature-icon">⚡</div>
-                            <h3>Optimize Performance</h3>
-                            <p>Improve algorithms, reduce complexity, and enhance efficiency</p>
-                        </div>
-                        <div class="feature">
-                            <div class="feature-icon">📚</div>
-                            <h3>Add Documentation</h3>
-                            <p>Generate comprehensive docstrings and type hints</p>
-                        </div>
-                        <div class="feature">
-                            <div class="feature-icon">✨</div>
-                            <h3>Style Improvements</h3>
-                            <p>Apply PEP 8 standards and improve code readability</p>
-                        </div>
-                        <div class="feature">
-                            <div class="feature-icon">🔒</div>
-                            <h3>Security Review</h3>
-                            <p>Identify vulnerabilities and apply security best practices</p>
-                        </div>
-                        <div class="feature">
-                            <div class="feature-icon">🎯</div>
-                            <h3>Smart Analysis</h3>
-                            <p>Context-aware suggestions based on your specific codebase</p>
-                        </div>
-                    </div>
-                </div>
-                
-                <div class="pricing">
-                    <div class="plan">
-                        <h3>Starter</h3>
-                        <div class="price">$9.90</div>
-                        <div class="per-refactor">$0.99 per refactor</div>
-                        <ul>
-                            <li>10 refactor requests</li>
-                            <li>All 5 refactor types</li>
-                            <li>API access</li>
-                            <li>Credits never expire</li>
-                            <li>Perfect for trying the service</li>
-                        </ul>
-                        <button onclick="buyPlan(990, 'Starter')">Get Started</button>
-                    </div>
-                    
-                    <div class="plan popular">
-                        <h3>Professional</h3>
-                        <div class="price">$29.90</div>
-                        <div class="per-refactor">$0.60 per refactor</div>
-                        <ul>
-                            <li>50 refactor requests</li>
-                            <li>All 5 refactor types</li>
-                            <li>API access</li>
-                            <li>Credits never expire</li>
-                            <li>40% savings vs Starter</li>
-                            <li>Best for regular use</li>
-                        </ul>
-                        <button onclick="buyPlan(2990, 'Professional')">Most Popular</button>
-                    </div>
-                    
-                    <div class="plan">
-                        <h3>Enterprise</h3>
-                        <div class="price">$99.90</div>
-                        <div class="per-refactor">$0.40 per refactor</div>
-                        <ul>
-                            <li>250 refactor requests</li>
-                            <li>All 5 refactor types</li>
-                            <li>API access</li>
-                            <li>Credits never expire</li>
-                            <li>60% savings vs Starter</li>
-                            <li>Perfect for teams</li>
-                        </ul>
-                        <button onclick="buyPlan(9990, 'Enterprise')">Maximum Value</button>
-                    </div>
-                </div>
-            </div>
-            
-            <div class="cta">
-                <h2>Ready to transform your code?</h2>
-                <p>Join the developers already using AI to write better, cleaner code</p>
-                <button onclick="buyPlan(2990, 'Professional')">Start Refactoring Now</button>
-                <button onclick="window.open('/docs', '_blank')" style="background: transparent; border: 2px solid white; color: white;">View API Docs</button>
-            </div>
-        </div>
-        
-        <script src="https://js.stripe.com/v3/"></script>
-        <script>
-        async function buyPlan(amount, planName) {
-            try {
-                const response = await fetch('/api/v1/payment/create-intent', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({
-                        amount: amount,
-                        currency: 'usd',
-                        description: `Refactor Agent ${planName} Plan`
-                    })
-                });
-                
-                const result = await response.json();
-                
-                if (result.success) {
-                    // Redirect to Stripe checkout or show payment form
-                    alert(`Payment created! API Key: ${result.api_key}\\nCredits: ${result.credits}\\n\\nIntegrate with Stripe checkout for production.`);
-                } else {
-                    alert('Error: ' + result.message);
-                }
-            } catch (error) {
-                alert('Error: ' + error.message);
-            }
-        }
-        </script>
-    </body>
-    </html>
-    """
-    return HTMLResponse(content=html_content)
+    use_gzip = "gzip" in request.headers.get("accept-encoding", "")
+    body, etag = LANDING_VARIANTS[use_gzip]
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=3600", "Vary": "Accept-Encoding"}
+    
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type="text/html; charset=utf-8", headers=headers)
 
 if __name__ == "__main__":
     import uvicorn
@@ -7,11 +7,88 @@ import stripe
 import os
 import json
 import logging
-from typing import Dict, Optional
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional, Union
 from datetime import datetime, timedelta
 
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib json module
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+@dataclass(frozen=True, slots=True)
+class PlanInfo:
+    """A purchasable credit plan"""
+    price_id: str
+    amount: int
+    credits: int
+    name: str
+
+# Plans are fixed at import and shared read-only by every instance
+# (update these with your actual Stripe Price IDs)
+PRICE_MAPPING: Mapping[str, PlanInfo] = MappingProxyType({
+    "starter": PlanInfo(
+        price_id="price_starter_id_here",  # Replace with actual Stripe Price ID
+        amount=990,
+        credits=10,
+        name="Starter"
+    ),
+    "professional": PlanInfo(
+        price_id="price_professional_id_here",  # Replace with actual Stripe Price ID
+        amount=2990,
+        credits=50,
+        name="Professional"
+    ),
+    "enterprise": PlanInfo(
+        price_id="price_enterprise_id_here",  # Replace with actual Stripe Price ID
+        amount=9990,
+        credits=250,
+        name="Enterprise"
+    )
+})
+
+# Static part of each plan's Checkout Session parameters; requests only add
+# their URLs and email. Shared nested values are never mutated.
+_SESSION_TEMPLATES: Dict[str, Dict] = {
+    plan: {
+        "payment_method_types": ["card"],
+        "line_items": [{
+            "price": info.price_id,
+            "quantity": 1,
+        }],
+        "mode": "payment",
+        "metadata": {
+            "service": "refactor_agent",
+            "plan": plan,
+            "credits": str(info.credits)
+        }
+    }
+    for plan, info in PRICE_MAPPING.items()
+}
+
+# Prices and payment links only change from the Stripe dashboard, so lookups
+# are shared by every RefactorAgentPayments instance for up to an hour
+PRICE_CACHE_SECONDS = 3600
+_price_cache: Dict[str, tuple] = {}         # price_id -> (expires_at, stripe.Price)
+_payment_link_cache: Dict[str, tuple] = {}  # plan -> (expires_at, url)
+
+# Verified webhook events are processed here, one at a time and in arrival
+# order, so the endpoint can acknowledge Stripe as soon as the signature checks out
+_event_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stripe-events")
+
+# Stripe redelivers an event for up to 3 days until it sees a 2xx, so ids of
+# handled events are kept that long. This is per process; multi-worker
+# deployments should also dedupe in shared storage (e.g. Redis SET NX).
+EVENT_DEDUPE_SECONDS = 72 * 3600
+EVENT_DEDUPE_MAX_ENTRIES = 10000
+_seen_events: Dict[str, float] = {}  # event id -> expires_at, in arrival order
+
 class RefactorAgentPayments:
     """Enhanced payment processing for Refactor Agent"""
     
@@ -21,66 +98,47 @@ class RefactorAgentPayments:
         
         if self.stripe_secret_key:
             stripe.api_key = self.stripe_secret_key
-        
-        # Price mapping (update these with your actual Stripe Price IDs)
-        self.price_mapping = {
-            "starter": {
-                "price_id": "price_starter_id_here",  # Replace with actual Stripe Price ID
-                "amount": 990,
-                "credits": 10,
-                "name": "Starter"
-            },
-            "professional": {
-                "price_id": "price_professional_id_here",  # Replace with actual Stripe Price ID
-                "amount": 2990, 
-                "credits": 50,
-                "name": "Professional"
-            },
-            "enterprise": {
-                "price_id": "price_enterprise_id_here",  # Replace with actual Stripe Price ID
-                "amount": 9990,
-                "credits": 250,
-                "name": "Enterprise"
-            }
-        }
     
     def create_checkout_session(self, plan: str, success_url: str, cancel_url: str, 
-                              customer_email: Optional[str] = None) -> Dict:
-        """Create a Stripe Checkout session"""
+                              customer_email: Optional[str] = None,
+                              idempotency_key: Optional[str] = None) -> Dict:
+        """
+        Create a Stripe Checkout session
         
-        if plan not in self.price_mapping:
-            raise ValueError(f"Invalid plan: {plan}")
+        Args:
+            idempotency_key: Identifies this purchase attempt; pass the key
+                returned by the first call when retrying it, so the retry gets
+                the same session back. A new key is generated when omitted.
+        """
         
-        plan_info = self.price_mapping[plan]
+        plan_info = PRICE_MAPPING.get(plan)
+        if plan_info is None:
+            raise ValueError(f"Invalid plan: {plan}")
         
         try:
             session_params = {
-                "payment_method_types": ["card"],
-                "line_items": [{
-                    "price": plan_info["price_id"],
-                    "quantity": 1,
-                }],
-                "mode": "payment",
+                **_SESSION_TEMPLATES[plan],
                 "success_url": success_url + "?session_id={CHECKOUT_SESSION_ID}",
-                "cancel_url": cancel_url,
-                "metadata": {
-                    "service": "refactor_agent",
-                    "plan": plan,
-                    "credits": str(plan_info["credits"])
-                }
+                "cancel_url": cancel_url
             }
             
             if customer_email:
                 session_params["customer_email"] = customer_email
             
-            session = stripe.checkout.Session.create(**session_params)
+            # One key per purchase attempt: two buyers (or one buyer buying twice)
+            # must never share a session. Each write type has its own key prefix
+            # (cs:, pl:; use e.g. re: for refunds) so keys never collide across calls
+            if idempotency_key is None:
+                idempotency_key = f"cs:{secrets.token_hex(16)}"
+            session = stripe.checkout.Session.create(**session_params, idempotency_key=idempotency_key)
             
             return {
                 "success": True,
                 "session_id": session.id,
+                "idempotency_key": idempotency_key,
                 "checkout_url": session.url,
-                "amount": plan_info["amount"],
-                "credits": plan_info["credits"]
+                "amount": plan_info.amount,
+                "credits": plan_info.credits
             }
             
         except stripe.error.StripeError as e:
@@ -90,16 +148,44 @@ class RefactorAgentPayments:
                 "error": str(e)
             }
     
-    def handle_webhook(self, payload: str, signature: str) -> Dict:
-        """Handle Stripe webhook events"""
+    def verify_webhook(self, payload: Union[bytes, str], signature: Optional[str]):
+        """
+        Check a webhook's signature and parse its event.
+        
+        Args:
+            payload: Raw request body, as bytes or str
+            signature: Value of the Stripe-Signature header (None if missing)
+        
+        Raises:
+            ValueError: If the payload is not a valid event
+            stripe.error.SignatureVerificationError: If the header is missing or
+                malformed, or no v1 signature matches within the tolerance
+        """
+        # verify_header signs "<timestamp>.<payload>" as text, so it needs a str
+        text = payload.decode("utf-8") if isinstance(payload, bytes) else payload
+        stripe.WebhookSignature.verify_header(
+            text, signature, self.webhook_secret, stripe.Webhook.DEFAULT_TOLERANCE
+        )
+        # Handlers only need plain dict access, so skip construct_event's
+        # OrderedDict parse and StripeObject wrapping of the whole event
+        return orjson.loads(payload) if orjson is not None else json.loads(payload)
+    
+    def handle_webhook(self, payload: Union[bytes, str], signature: Optional[str], defer: bool = False) -> Dict:
+        """
+        Handle Stripe webhook events
+        
+        Args:
+            payload: Raw request body, e.g. ``await request.body()`` unchanged
+            signature: Value of the Stripe-Signature header
+            defer: Return as soon as the event is verified and process it in
+                the background (Stripe only needs a fast 2xx)
+        """
         
         if not self.webhook_secret:
             return {"status": "error", "message": "Webhook secret not configured"}
         
         try:
-            event = stripe.Webhook.construct_event(
-                payload, signature, self.webhook_secret
-            )
+            event = self.verify_webhook(payload, signature)
         except ValueError as e:
             logger.error(f"Invalid payload: {e}")
             return {"status": "error", "message": "Invalid payload"}
@@ -107,7 +193,48 @@ class RefactorAgentPayments:
             logger.error(f"Invalid signature: {e}")
             return {"status": "error", "message": "Invalid signature"}
         
-        logger.info(f"Received webhook event: {event['type']}")
+        if not self._claim_event(event["id"]):
+            logger.info(f"Skipping duplicate webhook event: {event['id']}")
+            return {"status": "duplicate", "event_id": event["id"]}
+        
+        if defer:
+            _event_executor.submit(self._process_event_logged, event)
+            return {"status": "queued", "event_id": event["id"]}
+        try:
+            return self.process_event(event)
+        except Exception:
+            # Let Stripe's retry of this event through
+            _seen_events.pop(event["id"], None)
+            raise
+    
+    def _claim_event(self, event_id: str) -> bool:
+        """Record an event id, returning False if it was already handled"""
+        now = time.monotonic()
+        if _seen_events.get(event_id, 0.0) > now:
+            return False
+        
+        # Entries share one TTL, so the oldest (first) ones expire first
+        while _seen_events:
+            oldest = next(iter(_seen_events))
+            if _seen_events[oldest] > now and len(_seen_events) < EVENT_DEDUPE_MAX_ENTRIES:
+                break
+            del _seen_events[oldest]
+        
+        _seen_events[event_id] = now + EVENT_DEDUPE_SECONDS
+        return True
+    
+    def _process_event_logged(self, event):
+        """Run process_event for a deferred event; nobody awaits the result, so log failures"""
+        try:
+            self.process_event(event)
+        except Exception as e:
+            _seen_events.pop(event["id"], None)
+            logger.error(f"Error processing webhook event {event['id']}: {e}")
+    
+    def process_event(self, event) -> Dict:
+        """Dispatch a verified webhook event to its handler"""
+        
+        logger.info("Received webhook event: %s", event["type"])
         
         # Handle different event types
         if event["type"] == "checkout.session.completed":
@@ -124,11 +251,14 @@ class RefactorAgentPayments:
         
         customer_email = session.get("customer_email")
         customer_id = session.get("customer")
-        metadata = session.get("metadata", {})
+        # Stripe sends "metadata": null when none was set
+        metadata = session.get("metadata") or {}
         plan = metadata.get("plan")
-        credits = int(metadata.get("credits", 0))
+        credits_str = metadata.get("credits")
+        credits = int(credits_str) if credits_str else 0
         
-        logger.info(f"Checkout completed: {customer_email}, Plan: {plan}, Credits: {credits}")
+        # Lazy %-formatting: nothing is rendered when INFO is disabled
+        logger.info("Checkout completed: %s, Plan: %s, Credits: %d", customer_email, plan, credits)
         
         # Generate API key and activate credits
         api_key = self._generate_api_key()
@@ -164,29 +294,75 @@ class RefactorAgentPayments:
     
     def _generate_api_key(self) -> str:
         """Generate a unique API key"""
-        import uuid
-        return f"rfa_{uuid.uuid4().hex[:32]}"
+        return f"rfa_{secrets.token_urlsafe(24)}"
+    
+    def _warm_prices(self):
+        """Cache every plan's Stripe Price from a single list call"""
+        wanted = {info.price_id for info in PRICE_MAPPING.values()}
+        expires_at = time.monotonic() + PRICE_CACHE_SECONDS
+        # Price.list can't filter by id, but one page of active prices covers
+        # every plan instead of a retrieve round-trip per plan
+        for price in stripe.Price.list(active=True, limit=100).data:
+            if price.id in wanted:
+                _price_cache[price.id] = (expires_at, price)
+    
+    def _get_price(self, price_id: str):
+        """Retrieve a Stripe Price, reusing the cached copy for PRICE_CACHE_SECONDS"""
+        cached = _price_cache.get(price_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        
+        # A miss refreshes all plans at once; only prices outside the first
+        # page (or inactive ones) fall back to an individual retrieve
+        self._warm_prices()
+        cached = _price_cache.get(price_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        
+        price = stripe.Price.retrieve(price_id)
+        _price_cache[price_id] = (time.monotonic() + PRICE_CACHE_SECONDS, price)
+        return price
+    
+    def get_plan_prices(self) -> Dict[str, object]:
+        """Stripe Price for every plan, keyed by plan name"""
+        return {plan: self._get_price(info.price_id) for plan, info in PRICE_MAPPING.items()}
+    
+    def invalidate_prices(self):
+        """Drop cached prices and payment links (call after changing prices in Stripe)"""
+        _price_cache.clear()
+        _payment_link_cache.clear()
     
     def get_payment_link(self, plan: str) -> str:
         """Get a payment link for a specific plan"""
         
-        if plan not in self.price_mapping:
+        plan_info = PRICE_MAPPING.get(plan)
+        if plan_info is None:
             raise ValueError(f"Invalid plan: {plan}")
         
+        # A payment link can be shared by every buyer, so reuse it instead of
+        # creating a new one per call
+        cached = _payment_link_cache.get(plan)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        
         # Create a payment link (you can also do this in Stripe Dashboard)
         try:
             payment_link = stripe.PaymentLink.create(
+                # Keyed on everything sent, so a changed price or plan gets a
+                # new key instead of an idempotency parameter-mismatch error
+                idempotency_key=f"pl:{plan}:{plan_info.price_id}:{plan_info.credits}",
                 line_items=[{
-                    "price": self.price_mapping[plan]["price_id"],
+                    "price": plan_info.price_id,
                     "quantity": 1,
                 }],
                 metadata={
                     "service": "refactor_agent",
                     "plan": plan,
-                    "credits": str(self.price_mapping[plan]["credits"])
+                    "credits": str(plan_info.credits)
                 }
             )
             
+            _payment_link_cache[plan] = (time.monotonic() + PRICE_CACHE_SECONDS, payment_link.url)
             return payment_link.url
             
         except stripe.error.StripeError as e:
@@ -7,26 +7,21 @@ import sys
 import os
 import json
 from pathlib import Path
-from io import StringIO
-from contextlib import redirect_stdout
 
 # Add the parent directory to path for imports
 current_dir = Path(__file__).parent
 parent_dir = current_dir.parent
-sys.path.append(str(parent_dir))
-sys.path.append(str(parent_dir / "agent"))
+for import_dir in (str(parent_dir), str(parent_dir / "agent")):
+    if import_dir not in sys.path:
+        sys.path.append(import_dir)
 
 # Import the existing refactor functionality
-from main_agent import assistant, user
-from refactor_cli import get_suggestion_prompt
+from main_agent import run_chat
+from runner import parse_agent_output
+from refactor_cli import get_suggestion_prompt, build_refactor_message
 
-def test_refactor_agent():
-    """Test the refactor agent directly"""
-    print("🧪 Testing Refactor Agent API Functionality")
-    print("=" * 50)
-    
-    # Test code snippet - a simple example
-    test_code = '''def add(a, b):
+# Sample code sent to the agent; the full message is built once at import
+_TEST_CODE = '''def add(a, b):
     return a + b
 
 def subtract(a, b):
@@ -45,78 +40,46 @@ def calculate_interest(principal, rate, time):
 
 def calculate_compound_interest(principal, rate, time, compounds_per_year):
     return principal * (1 + rate / compounds_per_year) ** (compounds_per_year * time)'''
+_MESSAGE = build_refactor_message(get_suggestion_prompt("refactor"), _TEST_CODE)
+
+def test_refactor_agent():
+    """Test the refactor agent directly"""
+    print("🧪 Testing Refactor Agent API Functionality")
+    print("=" * 50)
     
     print("📝 Original Code:")
-    print(test_code)
+    print(_TEST_CODE)
     print("\n" + "=" * 50)
     
     try:
-        # Get suggestion prompt
-        suggestion_prompt = get_suggestion_prompt("refactor")
-        
-        # Prepare message
-        message = f"""
-        {suggestion_prompt}
-
-        Return the structured JSON output with these exact keys:
-        - 'refactored_main': The improved version of the original file
-        - 'backup_file': The old code to be saved to a separate file
-        - 'utility_modules': Dictionary of extracted utility modules (filename -> code)
-
-        Code to improve:
-        ```python
-        {test_code}
-        ```
-        """
-        
         print("🔄 Sending to refactor agent...")
         
-        # Capture stdout to get the agent's response
-        output_buffer = StringIO()
-        with redirect_stdout(output_buffer):
-            user.initiate_chat(assistant, message=message)
-        
-        # Get the captured output
-        captured_output = output_buffer.getvalue()
+        # The agent's final reply comes straight from the chat history
+        agent_reply = run_chat(_MESSAGE)
         
         print("\n📤 Raw Agent Response:")
-        print(captured_output)
+        print(agent_reply)
         
         # Parse the JSON response
-        json_start = captured_output.find('```json')
-        if json_start == -1:
-            json_start = captured_output.find('{')
+        try:
+            parsed_response = parse_agent_output(agent_reply)
+        except ValueError as e:
+            print(f"❌ JSON parsing error: {e}")
+            return None
         
-        json_end = captured_output.rfind('```')
-        if json_end == -1:
-            json_end = captured_output.rfind('}') + 1
+        print("\n✅ Parsed API Response:")
+        print(json.dumps(parsed_response, indent=2))
         
-        if json_start != -1 and json_end != -1:
-            json_str = captured_output[json_start:json_end].replace('```json', '').replace('```', '').strip()
-            try:
-                parsed_response = json.loads(json_str)
-                
-                print("\n✅ Parsed API Response:")
-                print(json.dumps(parsed_response, indent=2))
-                
-                print("\n📄 Refactored Main Code:")
-                print(parsed_response.get('refactored_main', 'No main code returned'))
-                
-                if 'utility_modules' in parsed_response:
-                    print("\n📁 Utility Modules:")
-                    for filename, content in parsed_response['utility_modules'].items():
-                        print(f"\n--- {filename} ---")
-                        print(content)
-                
-                return parsed_response
-                
-            except json.JSONDecodeError as e:
-                print(f"❌ JSON parsing error: {e}")
-                print(f"Raw JSON string: {json_str}")
-                return None
-        else:
-            print("❌ No JSON block found in response")
-            return None
+        print("\n📄 Refactored Main Code:")
+        print(parsed_response.get('refactored_main', 'No main code returned'))
+        
+        if 'utility_modules' in parsed_response:
+            print("\n📁 Utility Modules:")
+            for filename, content in parsed_response['utility_modules'].items():
+                print(f"\n--- {filename} ---")
+                print(content)
+        
+        return parsed_response
             
     except Exception as e:
         print(f"❌ Error during refactoring: {e}")
@@ -0,0 +1,281 @@
+"""
+Shared storage for the Refactor Agent API.
+Uses Redis when REDIS_URL is configured so API keys, credits and sessions are
+shared by every worker; otherwise falls back to an in-process store.
+"""
+
+import os
+import time
+import zlib
+import itertools
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis.asyncio as aioredis
+    from redis.exceptions import WatchError
+except ImportError:
+    aioredis = None
+
+    class WatchError(Exception):
+        """A WATCHed key changed before EXEC (mirrors redis.exceptions.WatchError)"""
+
+try:
+    import zstandard
+except ImportError:  # Fall back to zlib from the stdlib
+    zstandard = None
+
+# Codec used for large stored blobs; part of their keys so processes built
+# with different codecs never read each other's data
+if zstandard is not None:
+    BLOB_CODEC = "zstd"
+    # Shared per process; only used from the event loop thread
+    _compressor = zstandard.ZstdCompressor(level=3)
+    _decompressor = zstandard.ZstdDecompressor()
+else:
+    BLOB_CODEC = "zlib"
+
+
+def compress_blob(data: bytes) -> bytes:
+    """Compress a payload before it is written to storage"""
+    if zstandard is not None:
+        return _compressor.compress(data)
+    return zlib.compress(data, 6)
+
+
+def decompress_blob(blob: bytes) -> bytes:
+    """Reverse compress_blob"""
+    if zstandard is not None:
+        return _decompressor.decompress(blob)
+    return zlib.decompress(blob)
+
+
+class LocalPipeline:
+    """
+    Buffers LocalRedis commands and runs them in order on execute(),
+    mirroring a redis.asyncio pipeline, including WATCH/MULTI: after watch()
+    commands run immediately until multi(), and execute() raises WatchError
+    if a watched key was written in the meantime.
+    """
+
+    def __init__(self, client: "LocalRedis"):
+        self._client = client
+        self._commands = []
+        self._watched = {}
+        self._immediate = False
+
+    def __getattr__(self, name: str):
+        command = getattr(self._client, name)
+        if self._immediate:
+            return command
+
+        def queue(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    async def watch(self, *keys: str) -> bool:
+        self._watched.update((key, self._client._version(key)) for key in keys)
+        self._immediate = True
+        return True
+
+    def multi(self):
+        self._immediate = False
+
+    async def execute(self) -> list:
+        commands, self._commands = self._commands, []
+        watched, self._watched = self._watched, {}
+        self._immediate = False
+        if any(self._client._version(key) != version for key, version in watched.items()):
+            raise WatchError("Watched variable changed.")
+        # Nothing awaits in between, so the batch is as atomic as MULTI/EXEC
+        return [await command(*args, **kwargs) for command, args, kwargs in commands]
+
+    async def reset(self):
+        self._commands.clear()
+        self._watched.clear()
+        self._immediate = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.reset()
+
+
+class LocalRedis:
+    """
+    In-process stand-in for the subset of redis.asyncio commands the API uses.
+    Values are stored as strings, matching a client with decode_responses=True,
+    or as bytes when created with decode_responses=False.
+    State is per process, so only use it for local single-worker runs.
+    """
+
+    def __init__(self, decode_responses: bool = True):
+        self._data = {}
+        self._expires_at = {}
+        # key -> stamp of its last write, for WATCH; absent keys have none
+        self._versions = {}
+        self._write_stamps = itertools.count(1)
+        self._decode_responses = decode_responses
+
+    def _live(self, key: str) -> bool:
+        """Drop the key if its TTL has passed and report whether it still exists"""
+        expires_at = self._expires_at.get(key)
+        if expires_at is not None and time.monotonic() >= expires_at:
+            self._data.pop(key, None)
+            self._expires_at.pop(key, None)
+            self._versions.pop(key, None)
+        return key in self._data
+
+    def _touch(self, key: str):
+        """Record a write to key, invalidating any WATCH on it"""
+        self._versions[key] = next(self._write_stamps)
+
+    def _version(self, key: str) -> int:
+        self._live(key)
+        return self._versions.get(key, 0)
+
+    def _encode(self, value):
+        if not self._decode_responses:
+            return value if isinstance(value, bytes) else str(value).encode("utf-8")
+        if isinstance(value, bytes):
+            return value.decode("utf-8")
+        return value if isinstance(value, str) else str(value)
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._data.get(key) if self._live(key) else None
+
+    async def set(self, key: str, value, ex: Optional[int] = None, nx: bool = False) -> Optional[bool]:
+        if nx and self._live(key):
+            return None
+        self._data[key] = self._encode(value)
+        self._touch(key)
+        self._expires_at.pop(key, None)
+        if ex is not None:
+            self._expires_at[key] = time.monotonic() + ex
+        return True
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        new_value = int(self._data[key]) + amount if self._live(key) else amount
+        self._data[key] = self._encode(new_value)
+        self._touch(key)
+        return new_value
+
+    async def delete(self, *keys: str) -> int:
+        removed = 0
+        for key in keys:
+            if self._live(key):
+                del self._data[key]
+                removed += 1
+            self._expires_at.pop(key, None)
+            self._versions.pop(key, None)
+        return removed
+
+    async def exists(self, *keys: str) -> int:
+        return sum(1 for key in keys if self._live(key))
+
+    async def expire(self, key: str, seconds: int) -> bool:
+        if not self._live(key):
+            return False
+        self._expires_at[key] = time.monotonic() + seconds
+        self._touch(key)
+        return True
+
+    async def persist(self, key: str) -> bool:
+        if not self._live(key):
+            return False
+        self._touch(key)
+        return self._expires_at.pop(key, None) is not None
+
+    async def hgetall(self, key: str) -> Dict[str, str]:
+        return dict(self._data[key]) if self._live(key) else {}
+
+    async def hmget(self, key: str, *fields: str) -> list:
+        record = self._data[key] if self._live(key) else {}
+        return [record.get(field) for field in fields]
+
+    async def hget(self, key: str, field: str) -> Optional[str]:
+        return self._data[key].get(field) if self._live(key) else None
+
+    async def hset(self, key: str, field: Optional[str] = None, value=None,
+                   mapping: Optional[Dict] = None) -> int:
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        self._live(key)
+        record = self._data.setdefault(key, {})
+        added = sum(1 for name in items if name not in record)
+        record.update((name, self._encode(item)) for name, item in items.items())
+        self._touch(key)
+        return added
+
+    async def hincrby(self, key: str, field: str, amount: int = 1) -> int:
+        self._live(key)
+        record = self._data.setdefault(key, {})
+        new_value = int(record.get(field, 0)) + amount
+        record[field] = self._encode(new_value)
+        self._touch(key)
+        return new_value
+
+    async def zadd(self, key: str, mapping: Dict[str, float]) -> int:
+        self._live(key)
+        members = self._data.setdefault(key, {})
+        added = sum(1 for member in mapping if member not in members)
+        members.update((member, float(score)) for member, score in mapping.items())
+        self._touch(key)
+        return added
+
+    async def zrem(self, key: str, *members: str) -> int:
+        if not self._live(key):
+            return 0
+        removed = sum(1 for member in members if self._data[key].pop(member, None) is not None)
+        if removed:
+            self._touch(key)
+        return removed
+
+    async def zremrangebyscore(self, key: str, min_score, max_score) -> int:
+        if not self._live(key):
+            return 0
+        low, high = float(min_score), float(max_score)
+        members = self._data[key]
+        expired = [member for member, score in members.items() if low <= score <= high]
+        for member in expired:
+            del members[member]
+        if expired:
+            self._touch(key)
+        return len(expired)
+
+    async def zcard(self, key: str) -> int:
+        return len(self._data[key]) if self._live(key) else 0
+
+    def pipeline(self, transaction: bool = True) -> LocalPipeline:
+        return LocalPipeline(self)
+
+    async def aclose(self):
+        self._data.clear()
+        self._expires_at.clear()
+        self._versions.clear()
+
+
+def create_redis_client(decode_responses: bool = True):
+    """
+    Create the shared storage client for the API.
+
+    Args:
+        decode_responses: Return str values; pass False for a client that
+            reads and writes binary blobs
+    """
+    redis_url = os.getenv("REDIS_URL")
+
+    if redis_url and aioredis is not None:
+        # from_url connects lazily, so this is safe at import time
+        return aioredis.from_url(redis_url, decode_responses=decode_responses)
+
+    if redis_url:
+        logger.warning("REDIS_URL is set but the redis package is not installed. Using in-process storage.")
+    else:
+        logger.warning("REDIS_URL not set. Using in-process storage (single worker only).")
+    return LocalRedis(decode_responses=decode_responses)
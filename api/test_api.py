@@ -7,27 +7,35 @@ import sys
 import os
 import json
 from pathlib import Path
-from datetime import datetime
+import time
+import hmac
+import asyncio
+import hashlib
 
 # Add the parent directory to path for imports
 current_dir = Path(__file__).parent
 parent_dir = current_dir.parent
-sys.path.append(str(parent_dir))
-sys.path.append(str(parent_dir / "agent"))
+for import_dir in (str(parent_dir), str(parent_dir / "agent")):
+    if import_dir not in sys.path:
+        sys.path.append(import_dir)
 
 # Import our API modules
-from api.main import app, api_keys, generate_api_key, refactor_code_async
-from main_agent import assistant, user
+import api.main
+from fastapi import HTTPException
+from api.main import app, redis_client, api_key_record, format_timestamp, generate_api_key, refactor_code_async, activate_api_key, credit_guard
+from api.storage import LocalRedis
+from api.payment_integration import RefactorAgentPayments
+import main_agent
 
-def simulate_api_key_creation():
+async def simulate_api_key_creation():
     """Simulate creating an API key for testing"""
     api_key = generate_api_key()
-    api_keys[api_key] = {
+    await redis_client.hset(api_key_record(api_key), mapping={
         "credits": 5,
         "total_requests": 0,
-        "created_at": datetime.now(),
+        "created_at": time.time_ns(),
         "status": "active"
-    }
+    })
     return api_key
 
 async def test_refactor_code():
@@ -91,28 +99,175 @@ def process_order(items, discount_percent=0, tax_rate=0.08):
         traceback.print_exc()
         return None
 
-def test_api_key_management():
+async def test_api_key_management():
     """Test API key creation and management"""
     print("\n🔑 Testing API Key Management")
     print("=" * 30)
     
     # Create test API key
-    api_key = simulate_api_key_creation()
+    api_key = await simulate_api_key_creation()
     print(f"✅ Generated API Key: {api_key}")
     
     # Check key info
-    key_info = api_keys[api_key]
+    key_info = await redis_client.hgetall(api_key_record(api_key))
     print(f"📊 Key Info: {json.dumps(key_info, default=str, indent=2)}")
     
     return api_key
 
-def demonstrate_full_api_flow():
+class RoundTripRedis(LocalRedis):
+    """LocalRedis that yields to the event loop after reads, like a networked client"""
+
+    async def hgetall(self, key: str):
+        record = await super().hgetall(key)
+        # Other tasks run before the reply "arrives", so they can act on stale data
+        await asyncio.sleep(0)
+        return record
+
+class CrashingRedis(RoundTripRedis):
+    """RoundTripRedis whose next transaction dies before EXEC, like a killed worker"""
+
+    def __init__(self):
+        super().__init__()
+        self.crash_next = True
+
+    def pipeline(self, transaction: bool = True):
+        pipe = super().pipeline(transaction)
+        execute = pipe.execute
+
+        async def crash_then_execute():
+            if self.crash_next:
+                self.crash_next = False
+                raise asyncio.CancelledError
+            return await execute()
+        pipe.execute = crash_then_execute
+        return pipe
+
+async def create_pending_key(storage: LocalRedis) -> str:
+    api_key = generate_api_key()
+    await storage.hset(api_key_record(api_key), mapping={
+        "credits": 0,
+        "total_requests": 0,
+        "created_at": time.time_ns(),
+        "payment_intent": "pi_test",
+        "pending_credits": 100,
+        "status": "pending"
+    })
+    return api_key
+
+async def test_concurrent_activation():
+    """Confirm and the webhook activating the same key at once credit it only once"""
+    print("\n🔒 Testing Concurrent Activation")
+    print("=" * 30)
+
+    async def activate_and_read(storage, api_key):
+        # Credits as seen the moment activation reports success
+        activated = await activate_api_key(api_key, "pi_test")
+        return activated, int((await storage.hgetall(api_key_record(api_key)))["credits"])
+
+    storage = RoundTripRedis()
+    original_client, api.main.redis_client = api.main.redis_client, storage
+    try:
+        api_key = await create_pending_key(storage)
+        # Both callers read "pending" before either one writes
+        results = await asyncio.gather(
+            activate_and_read(storage, api_key),
+            activate_and_read(storage, api_key)
+        )
+        key_info = await storage.hgetall(api_key_record(api_key))
+
+        # An activation that dies between its check and its credit leaves the
+        # key pending, so the next confirm or webhook still credits it
+        storage = api.main.redis_client = CrashingRedis()
+        crashed_key = await create_pending_key(storage)
+        try:
+            await activate_api_key(crashed_key, "pi_test")
+        except asyncio.CancelledError:
+            pass
+        else:
+            raise AssertionError("activation should have been interrupted")
+        interrupted_info = await storage.hgetall(api_key_record(crashed_key))
+        retried = await activate_and_read(storage, crashed_key)
+    finally:
+        api.main.redis_client = original_client
+
+    assert results == [(True, 100), (True, 100)], results
+    assert key_info["status"] == "active"
+    assert int(key_info["credits"]) == 100, key_info["credits"]
+    assert interrupted_info["status"] == "pending" and int(interrupted_info["credits"]) == 0, interrupted_info
+    assert retried == (True, 100), retried
+    print(f"✅ Credits after two activations: {key_info['credits']}; interrupted activation recovered")
+
+async def test_leaked_reservation_expires():
+    """A reservation left by a killed worker frees its credit once it expires"""
+    print("\n⏳ Testing Leaked Reservation Expiry")
+    print("=" * 30)
+
+    storage = LocalRedis()
+    original = api.main.redis_client, api.main.RESERVATION_TTL_SECONDS
+    api.main.redis_client, api.main.RESERVATION_TTL_SECONDS = storage, 1
+    try:
+        api_key = generate_api_key()
+        await storage.hset(api_key_record(api_key), mapping={"credits": 1, "status": "active"})
+
+        # Enter the guard and never exit it, like a worker killed mid-refactor
+        await credit_guard(api_key).__aenter__()
+        try:
+            async with credit_guard(api_key):
+                pass
+        except HTTPException as exc:
+            blocked = exc.status_code
+        else:
+            blocked = None
+
+        await asyncio.sleep(1.1)
+        async with credit_guard(api_key):
+            pass
+        credits = int(await storage.hget(api_key_record(api_key), "credits"))
+    finally:
+        api.main.redis_client, api.main.RESERVATION_TTL_SECONDS = original
+
+    assert blocked == 402, blocked
+    assert credits == 0, credits
+    print("✅ Leaked reservation blocked the last credit until it expired")
+
+def test_create_agents():
+    """Agents build with the real autogen and share main_agent's HTTP client"""
+    print("\n🤖 Testing Agent Creation")
+    print("=" * 30)
+
+    # ConversableAgent deep-copies llm_config; the shared client must survive it
+    assistant, user = main_agent.create_agents()
+    for agent in (assistant, user):
+        assert agent.llm_config["config_list"][0]["http_client"] is main_agent.http_client
+    print("✅ Both agents share one HTTP client")
+
+def test_webhook_signature_headers():
+    """Missing or malformed Stripe-Signature headers are rejected, not raised"""
+    print("\n✍️ Testing Webhook Signature Headers")
+    print("=" * 30)
+
+    payments = RefactorAgentPayments()
+    payments.webhook_secret = "whsec_test"
+    payload = b'{"id": "evt_signature_test", "type": "test.event", "data": {"object": {}}}'
+    timestamp = int(time.time())
+    signature = hmac.new(b"whsec_test", b"%d.%s" % (timestamp, payload), hashlib.sha256).hexdigest()
+
+    bad_headers = [None, "", "garbage", f"t={timestamp}", f"t=abc,v1={signature}", f"t={timestamp},v1=deadbeef"]
+    for header in bad_headers:
+        result = payments.handle_webhook(payload, header)
+        assert result == {"status": "error", "message": "Invalid signature"}, (header, result)
+
+    result = payments.handle_webhook(payload, f"t={timestamp},v1=deadbeef,v1={signature}")
+    assert result["status"] == "ignored", result
+    print(f"✅ Rejected {len(bad_headers)} bad headers, accepted the signed event")
+
+async def demonstrate_full_api_flow():
     """Demonstrate the complete API flow"""
     print("\n🔄 Complete API Flow Demonstration")
     print("=" * 40)
     
     # Step 1: Create API key
-    api_key = test_api_key_management()
+    api_key = await test_api_key_management()
     
     # Step 2: Show what a payment request would look like
     print("\n💳 Payment Request Example:")
@@ -134,17 +289,16 @@ def demonstrate_full_api_flow():
     
     # Step 4: Show usage tracking
     print("\n📈 Usage Tracking:")
+    key_info = await redis_client.hgetall(api_key_record(api_key))
     usage_info = {
         "api_key": api_key,
-        "total_requests": api_keys[api_key]["total_requests"],
-        "remaining_credits": api_keys[api_key]["credits"],
-        "created_at": api_keys[api_key]["created_at"].isoformat()
+        "total_requests": int(key_info["total_requests"]),
+        "remaining_credits": int(key_info["credits"]),
+        "created_at": format_timestamp(key_info["created_at"])
     }
     print(json.dumps(usage_info, indent=2))
 
 if __name__ == "__main__":
-    import asyncio
-    
     print("🚀 Refactor Agent API Test Suite")
     print("=" * 50)
     
@@ -155,10 +309,15 @@ if __name__ == "__main__":
     
     print("✅ OpenAI API Key is configured")
     
-    # Run async test
-    asyncio.run(test_refactor_code())
+    async def run_all():
+        # Share one event loop so the storage client's connections stay valid
+        test_create_agents()
+        await test_concurrent_activation()
+        await test_leaked_reservation_expires()
+        test_webhook_signature_headers()
+        await test_refactor_code()
+        await demonstrate_full_api_flow()
     
-    # Run sync tests
-    demonstrate_full_api_flow()
+    asyncio.run(run_all())
     
     print("\n🎉 Test completed!")
\ No newline at end of file
@@ -3,20 +3,28 @@
 Test the API endpoints to show what they return
 """
 
-import requests
+import httpx
 import json
 import time
+import importlib.util
 
 # Test configuration
 BASE_URL = "http://127.0.0.1:8000"
 
+# One pooled client, so every test after the first reuses the same connection
+client = httpx.Client(
+    base_url=BASE_URL,
+    http2=importlib.util.find_spec("h2") is not None,
+    timeout=10
+)
+
 def test_health_endpoint():
     """Test the health check endpoint"""
     print("🏥 Testing Health Endpoint")
     print("=" * 30)
     
     try:
-        response = requests.get(f"{BASE_URL}/api/v1/health", timeout=5)
+        response = client.get("/api/v1/health", timeout=5)
         print(f"Status Code: {response.status_code}")
         print(f"Response: {json.dumps(response.json(), indent=2)}")
         return response.status_code == 200
@@ -30,7 +38,7 @@ def test_pricing_endpoint():
     print("=" * 30)
     
     try:
-        response = requests.get(f"{BASE_URL}/api/v1/pricing", timeout=5)
+        response = client.get("/api/v1/pricing", timeout=5)
         print(f"Status Code: {response.status_code}")
         print(f"Response: {json.dumps(response.json(), indent=2)}")
         return response.status_code == 200
@@ -50,8 +58,8 @@ def test_payment_endpoint():
             "description": "Test purchase"
         }
         
-        response = requests.post(
-            f"{BASE_URL}/api/v1/payment/create-intent",
+        response = client.post(
+            "/api/v1/payment/create-intent",
             json=payload,
             timeout=10
         )
@@ -78,8 +86,8 @@ def test_refactor_endpoint_without_auth():
             "language": "python"
         }
         
-        response = requests.post(
-            f"{BASE_URL}/api/v1/refactor",
+        response = client.post(
+            "/api/v1/refactor",
             json=payload,
             timeout=10
         )
@@ -106,8 +114,8 @@ def test_with_mock_api_key():
     # Test usage endpoint with mock key
     try:
         headers = {"Authorization": f"Bearer {mock_api_key}"}
-        response = requests.get(
-            f"{BASE_URL}/api/v1/usage",
+        response = client.get(
+            "/api/v1/usage",
             headers=headers,
             timeout=5
         )
@@ -161,9 +169,10 @@ def show_expected_responses():
     }
     print(json.dumps(pricing_response, indent=2))
     
-    print("\n🔧 Successful Refactor Response:")
+    print("\n🔧 Successful Refactor Status Response:")
     refactor_response = {
         "success": True,
+        "status": "done",
         "refactored_main": "from utils.helpers import helper_function\n\ndef main():\n    return helper_function()",
         "utility_modules": {
             "utils/helpers.py": "def helper_function():\n    return 'Hello, World!'"
@@ -199,6 +208,7 @@ def main():
         except Exception as e:
             print(f"❌ {name} test crashed: {e}")
             results.append((name, False))
+    client.close()
     
     print("\n📊 Test Results Summary")
     print("=" * 30)
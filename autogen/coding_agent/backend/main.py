@@ -1,48 +1,177 @@
-import requests
+import httpx
+import asyncio
 import re
-from typing import List, Dict, Optional
+import string
+from collections import Counter, defaultdict
+from typing import AsyncIterator, Iterator, List, Dict, Optional, Tuple, Union
 import time
 
+try:
+    import ahocorasick
+except ImportError:  # Fall back to one precompiled regex per keyword
+    ahocorasick = None
+
+# Compiled once at import instead of on every extract_links call
+_LINK_RE = re.compile(r'href=["\']([^"\']+)["\']')
+
+MAX_CONNECTIONS = 100
+STREAM_CHUNK_SIZE = 64 * 1024
+# Aho-Corasick matches lowercase text; content is lowered this much at a time
+LOWER_CHUNK_SIZE = 64 * 1024
+# Keyword matching folds ASCII letters only. str.lower() can change a string's
+# length ('İ' lowers to two code points), which would shift every position after
+# it, so non-ASCII text is compared exactly as written
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+def _ascii_lower(text: str) -> str:
+    """Lowercase A-Z only, keeping the text's length (and so its offsets)"""
+    # lower() is faster and already length-preserving on pure-ASCII text
+    return text.lower() if text.isascii() else text.translate(_ASCII_LOWER)
+
 class WebScraper:
     def __init__(self, base_url: str):
         self.base_url = base_url
-        self.session = requests.Session()
+        # One keep-alive pool shared by every concurrent fetch
+        self.session = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS),
+            follow_redirects=True
+        )
+
+    async def __aenter__(self):
+        return self
 
-    def scrape_page(self, url: str) -> str:
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.session.aclose()
+
+    async def scrape_page(self, url: str) -> str:
         """Scrape content from a given URL"""
         try:
-            response = self.session.get(url)
+            response = await self.session.get(url)
             response.raise_for_status()
             return response.text
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"Error scraping {url}: {e}")
             return ""
 
+    async def stream_page(self, url: str, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[str]:
+        """Yield a page's text in chunks as it downloads, never holding the whole page"""
+        try:
+            async with self.session.stream("GET", url) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_text(chunk_size):
+                    yield chunk
+        except httpx.HTTPError as e:
+            print(f"Error scraping {url}: {e}")
+
+    async def scrape_many(self, urls: List[str], max_in_flight: int = MAX_CONNECTIONS) -> List[str]:
+        """
+        Scrape several URLs concurrently, returning their content in order.
+
+        Args:
+            urls: Pages to fetch
+            max_in_flight: Requests allowed at once; further URLs wait their turn
+                instead of piling up behind the connection pool
+        """
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def fetch(url: str) -> str:
+            async with semaphore:
+                return await self.scrape_page(url)
+
+        return await asyncio.gather(*(fetch(url) for url in urls))
+
     def extract_links(self, html_content: str) -> List[str]:
         """Extract all links from HTML content"""
-        link_pattern = r'href=["\']([^"\']+)["\']'
-        return re.findall(link_pattern, html_content)
+        return _LINK_RE.findall(html_content)
 
 class KeywordFlagger:
     def __init__(self, keywords: List[str]):
-        self.keywords = [kw.lower() for kw in keywords]
-
-    def check_content(self, content: str) -> Dict[str, List[str]]:
-        """Check content for flagged keywords and return matches"""
-        content_lower = content.lower()
-        matches = {}
-
+        self.keywords = [_ascii_lower(kw) for kw in keywords]
+        # Case-insensitive patterns, so the content never needs a lowered copy
+        self._keyword_res = [self._compile(kw) for kw in self.keywords]
+        # Built on first use and after add_keyword
+        self._automaton = None
+
+    @staticmethod
+    def _compile(keyword: str):
+        # re.ASCII limits IGNORECASE to A-Z, matching the automaton's folding
+        return re.compile(re.escape(keyword), re.IGNORECASE | re.ASCII)
+
+    def _build_automaton(self):
+        automaton = ahocorasick.Automaton()
         for keyword in self.keywords:
-            if keyword in content_lower:
-                # Find all occurrences
-                positions = [m.start() for m in re.finditer(re.escape(keyword), content_lower)]
-                matches[keyword] = positions
-
-        return matches
+            automaton.add_word(keyword, keyword)
+        automaton.make_automaton()
+        return automaton
+
+    def _iter_matches(self, content: str) -> Iterator[Tuple[str, int]]:
+        """Yield (keyword, start) for every match; positions ascend per keyword"""
+        if ahocorasick is not None and self.keywords:
+            # One pass over the content for every keyword at once
+            if self._automaton is None:
+                self._automaton = self._build_automaton()
+            # Lower one slice at a time instead of copying the whole content;
+            # each slice re-reads the previous one's last (longest keyword - 1)
+            # characters so boundary-spanning matches are found once
+            overlap = max(map(len, self.keywords), default=1) - 1
+            for start in range(0, len(content), LOWER_CHUNK_SIZE):
+                window_start = max(0, start - overlap)
+                window = _ascii_lower(content[window_start:start + LOWER_CHUNK_SIZE])
+                for end_index, keyword in self._automaton.iter(window):
+                    if window_start + end_index >= start:
+                        yield keyword, window_start + end_index - len(keyword) + 1
+            return
+
+        for keyword, keyword_re in zip(self.keywords, self._keyword_res):
+            for match in keyword_re.finditer(content):
+                yield keyword, match.start()
+
+    def check_content(self, content: str, count_only: bool = False) -> Union[Dict[str, List[int]], Dict[str, int]]:
+        """
+        Check content for flagged keywords and return matches
+
+        Args:
+            content: Text to scan
+            count_only: Return {keyword: count} instead of building the
+                position lists, for callers that only need totals
+        """
+        if count_only:
+            return dict(Counter(keyword for keyword, _ in self._iter_matches(content)))
+
+        matches = defaultdict(list)
+        for keyword, position in self._iter_matches(content):
+            matches[keyword].append(position)
+        return dict(matches)
+
+    async def scan_stream(self, chunks: AsyncIterator[str]) -> AsyncIterator[Tuple[str, int]]:
+        """
+        Yield (keyword, position) for matches in streamed text.
+
+        Only one chunk plus a short overlap is held at a time. The overlap
+        (the longest keyword minus one character) catches matches that span
+        a chunk boundary without reporting any match twice.
+        """
+        overlap = max(map(len, self.keywords), default=1) - 1
+        tail = ""
+        offset = 0  # Absolute position of tail[0]
+
+        async for chunk in chunks:
+            window = tail + chunk
+            for keyword, start in self._iter_matches(window):
+                # Matches entirely inside the tail were reported last chunk
+                if start + len(keyword) > len(tail):
+                    yield keyword, offset + start
+            tail = window[-overlap:] if overlap else ""
+            offset += len(window) - len(tail)
 
     def add_keyword(self, keyword: str):
         """Add a new keyword to monitor"""
-        self.keywords.append(keyword.lower())
+        self.keywords.append(_ascii_lower(keyword))
+        self._keyword_res.append(self._compile(keyword))
+        self._automaton = None
 
 class NotificationService:
     def __init__(self, email_config: Optional[Dict] = None):
@@ -60,30 +189,30 @@ class NotificationService:
             report += f"- {key}: {value}\n"
         print(report)
 
-def main():
+async def main():
     # Initialize components
-    scraper = WebScraper("https://example.com")
     flagger = KeywordFlagger(["urgent", "critical", "error", "warning"])
     notifier = NotificationService()
 
-    # Scrape some content
-    content = scraper.scrape_page("https://example.com")
-
-    # Check for flagged keywords
-    matches = flagger.check_content(content)
+    # Scrape some content, checking for flagged keywords as it streams in;
+    # only the totals are reported, so positions are counted, not stored
+    matches = Counter()
+    async with WebScraper("https://example.com") as scraper:
+        async for keyword, _ in flagger.scan_stream(scraper.stream_page("https://example.com")):
+            matches[keyword] += 1
 
     # Send notifications if matches found
     if matches:
-        for keyword, positions in matches.items():
-            notifier.send_alert(f"Keyword '{keyword}' found {len(positions)} times", "high")
+        for keyword, count in matches.items():
+            notifier.send_alert(f"Keyword '{keyword}' found {count} times", "high")
 
     # Send daily report
     stats = {
         "pages_scraped": 1,
         "keywords_found": len(matches),
-        "total_matches": sum(len(pos) for pos in matches.values())
+        "total_matches": sum(matches.values())
     }
     notifier.send_daily_report(stats)
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -13,6 +13,13 @@ config_list = [
     }
 ]
 
+# Shared LLM settings: cache_seed turns on autogen's on-disk response cache
+llm_config = {
+    "config_list": config_list,
+    "cache_seed": 42,
+    "temperature": 0
+}
+
 # System prompt defines the task
 system_prompt = """
 You're DevAgent. You take my scraper + keyword flagger code and:
@@ -26,13 +33,17 @@ Always ask follow-up questions before refactoring.
 assistant = AssistantAgent(
     name="DevAgent",
     system_message=system_prompt,
-    llm_config={"config_list": config_list}
+    llm_config=llm_config,
+    code_execution_config=False,
+    max_consecutive_auto_reply=1  # Limit to 1 auto-reply to prevent loops
 )
 
 user = UserProxyAgent(
     name="Developer",
     human_input_mode="NEVER",  # Set to "ALWAYS" if you want to interact manually
-    llm_config={"config_list": config_list}
+    llm_config=llm_config,
+    code_execution_config=False,  # Never run code blocks from the reply
+    max_consecutive_auto_reply=1  # Limit to 1 auto-reply to prevent loops
 )
 
 def main():
@@ -1,15 +1,75 @@
 # Sample main.py file for testing refactor agent
 
 import os
+import re
+import sys
+import copy
 import json
+import time
+import asyncio
+import logging
+import functools
+import importlib.util
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
 
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib json module
+    orjson = None
+
+# Shared session so repeated requests reuse pooled TCP/TLS connections
+_session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=100,
+    max_retries=Retry(total=3, backoff_factor=0.2)
+)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+# Logger for log_message; formatting only happens for records that pass the level
+_log = logging.getLogger("refactor_agent")
+if not _log.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s", "%Y-%m-%d %H:%M:%S"))
+    _log.addHandler(_handler)
+    _log.setLevel(logging.INFO)
+    _log.propagate = False
+
+# Large buffer so config reads/writes finish in as few syscalls as possible
+_IO_BUFFER_SIZE = 1 << 20
+
+def _json_loads(data):
+    """Parse JSON bytes, using orjson when it is installed"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def _json_dumps(data):
+    """Serialize to indented UTF-8 JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+
+# Compiled once; \Z rejects a trailing newline that $ would accept
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\Z', re.ASCII)
+
+@functools.lru_cache(maxsize=128)
+def _load_config(abspath, mtime_ns, size):
+    """Parse a config file; keyed on mtime/size so edits invalidate the entry"""
+    # Both parsers accept bytes, so skip the separate str decode step
+    with open(abspath, 'rb', buffering=_IO_BUFFER_SIZE) as f:
+        return _json_loads(f.read())
+
 def read_config_file(filepath):
     """Read configuration from a JSON file"""
     try:
-        with open(filepath, 'r') as f:
-            return json.load(f)
+        abspath = os.path.abspath(filepath)
+        stat = os.stat(abspath)
+        # Hand out a copy so callers can't mutate the cached entry
+        return copy.deepcopy(_load_config(abspath, stat.st_mtime_ns, stat.st_size))
     except FileNotFoundError:
         print(f"Config file not found: {filepath}")
         return {}
@@ -20,20 +80,20 @@ def read_config_file(filepath):
 def save_config_file(filepath, config_data):
     """Save configuration to a JSON file"""
     try:
-        with open(filepath, 'w') as f:
-            json.dump(config_data, f, indent=2)
+        with open(filepath, 'wb', buffering=_IO_BUFFER_SIZE) as f:
+            f.write(_json_dumps(config_data))
         return True
     except Exception as e:
         print(f"Error saving config: {e}")
         return False
 
-def make_api_request(url, method="GET", data=None, headers=None):
+def make_api_request(url, method="GET", data=None, headers=None, timeout=30):
     """Make an HTTP request to an API endpoint"""
     try:
         if method.upper() == "GET":
-            response = requests.get(url, headers=headers)
+            response = _session.get(url, headers=headers, timeout=timeout)
         elif method.upper() == "POST":
-            response = requests.post(url, json=data, headers=headers)
+            response = _session.post(url, json=data, headers=headers, timeout=timeout)
         else:
             raise ValueError(f"Unsupported HTTP method: {method}")
 
@@ -43,23 +103,51 @@ def make_api_request(url, method="GET", data=None, headers=None):
         print(f"API request failed: {e}")
         return None
 
+async def make_api_request_async(client, url, method="GET", data=None, headers=None, timeout=30):
+    """Make an HTTP request to an API endpoint over a shared httpx.AsyncClient"""
+    method = method.upper()
+    if method not in ("GET", "POST"):
+        raise ValueError(f"Unsupported HTTP method: {method}")
+
+    try:
+        response = await client.request(
+            method, url, json=data if method == "POST" else None, headers=headers, timeout=timeout
+        )
+        response.raise_for_status()
+        return response.json()
+    except httpx.HTTPError as e:
+        print(f"API request failed: {e}")
+        return None
+
+async def fetch_all(urls, headers=None, timeout=30):
+    """GET several endpoints concurrently; takes as long as the slowest one, not the sum"""
+    async with httpx.AsyncClient(http2=importlib.util.find_spec("h2") is not None) as client:
+        return await asyncio.gather(
+            *(make_api_request_async(client, url, headers=headers, timeout=timeout) for url in urls)
+        )
+
+# (epoch second, formatted string) of the last "now" timestamp
+_last_timestamp = [0, ""]
+
 def format_timestamp(timestamp=None):
     """Format a timestamp in a readable format"""
-    if timestamp is None:
-        timestamp = datetime.now()
-    return timestamp.strftime("%Y-%m-%d %H:%M:%S")
+    if timestamp is not None:
+        return timestamp.strftime("%Y-%m-%d %H:%M:%S")
+
+    # Reformat only when the wall-clock second changes
+    second = int(time.time())
+    if second != _last_timestamp[0]:
+        _last_timestamp[1] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        _last_timestamp[0] = second
+    return _last_timestamp[1]
 
 def log_message(message, level="INFO"):
     """Log a message with timestamp and level"""
-    timestamp = format_timestamp()
-    formatted_message = f"[{timestamp}] {level}: {message}"
-    print(formatted_message)
+    _log.log(getattr(logging, level.upper(), logging.INFO), "%s", message)
 
 def validate_email(email):
     """Basic email validation"""
-    import re
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return _EMAIL_RE.match(email) is not None
 
 def main():
     # Main application logic
@@ -72,7 +160,7 @@ def main():
     log_message("Starting application")
 
     # Make API request
-    response = make_api_request(config.get("api_url"))
+    response = make_api_request(config.get("api_url"), timeout=config.get("timeout", 30))
 
     if response:
         log_message("API request successful")
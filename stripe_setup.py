@@ -5,12 +5,52 @@ Run this to create products and prices in your Stripe account
 
 import stripe
 import os
+import asyncio
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Initialize Stripe
+# Initialize Stripe; the httpx client is what the SDK's *_async methods run on
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# Same per-call bound as the API, instead of the SDK's 80 second default
+stripe.default_http_client = stripe.HTTPXClient(timeout=float(os.getenv("STRIPE_TIMEOUT_SECONDS", "10")))
+
+async def create_product_and_price(product_data):
+    """Create one product, then its price; returns None if either call fails"""
+    try:
+        # Create product
+        product = await stripe.Product.create_async(
+            name=product_data["name"],
+            description=product_data["description"],
+            metadata={
+                "credits": str(product_data["credits"]),
+                "service": "refactor_agent"
+            }
+        )
+        
+        # Create price (needs the product id, so it follows its own product)
+        price = await stripe.Price.create_async(
+            unit_amount=product_data["price"],
+            currency="usd",
+            product=product.id,
+            metadata={
+                "credits": str(product_data["credits"])
+            }
+        )
+    except Exception as e:
+        print(f"❌ Error creating {product_data['name']}: {e}")
+        return None
+    
+    return {
+        "product": product,
+        "price": price,
+        "credits": product_data["credits"]
+    }
+
+async def create_products_and_prices_async(products):
+    """Create every product/price pair concurrently: two round-trips in total, not two per plan"""
+    results = await asyncio.gather(*(create_product_and_price(product_data) for product_data in products))
+    return [result for result in results if result is not None]
 
 def create_products_and_prices():
     """Create products and prices in Stripe"""
@@ -36,45 +76,16 @@ def create_products_and_prices():
         }
     ]
     
-    created_products = []
+    created_products = asyncio.run(create_products_and_prices_async(products))
     
-    for product_data in products:
-        try:
-            # Create product
-            product = stripe.Product.create(
-                name=product_data["name"],
-                description=product_data["description"],
-                metadata={
-                    "credits": str(product_data["credits"]),
-                    "service": "refactor_agent"
-                }
-            )
-            
-            # Create price
-            price = stripe.Price.create(
-                unit_amount=product_data["price"],
-                currency="usd",
-                product=product.id,
-                metadata={
-                    "credits": str(product_data["credits"])
-                }
-            )
-            
-            created_products.append({
-                "product": product,
-                "price": price,
-                "credits": product_data["credits"]
-            })
-            
-            print(f"✅ Created: {product.name}")
-            print(f"   Product ID: {product.id}")
-            print(f"   Price ID: {price.id}")
-            print(f"   Amount: ${product_data['price']/100:.2f}")
-            print(f"   Credits: {product_data['credits']}")
-            print()
-            
-        except Exception as e:
-            print(f"❌ Error creating {product_data['name']}: {e}")
+    for created in created_products:
+        product, price = created["product"], created["price"]
+        print(f"✅ Created: {product.name}")
+        print(f"   Product ID: {product.id}")
+        print(f"   Price ID: {price.id}")
+        print(f"   Amount: ${price.unit_amount/100:.2f}")
+        print(f"   Credits: {created['credits']}")
+        print()
     
     return created_products
 